@@ -44,10 +44,14 @@ def main():
 
 
     def execute_repocommand(args):
-        l.execute_repositorycommand(args.repo, args.cmd)
+        # les arguments de la commande sont passés à la méthode du référentiel
+        options = {k: v for k, v in vars(args).items() if k not in ('func', 'cmd', 'repo')}
+        l.execute_repositorycommand(args.repo, args.cmd, **options)
 
     def execute_program(args):
-        l.execute_programcommand(args.prog, args.cmd)
+        # les arguments optionnels de la commande sont passés au programme
+        options = {k: v for k, v in vars(args).items() if k not in ('func', 'cmd', 'prog')}
+        l.execute_programcommand(args.prog, args.cmd, **options)
 
     def execute_filterforvisualisation(args):
         l.execute_filterforvisualisationcommand(args.vis, args.cmd)
@@ -73,6 +77,8 @@ def main():
             repo_subparser = repo_parser.add_subparsers(help=r + ' Repository Commands.')
             for cmd, desc in l.get_repositorycommands(r):
                 cmd_parser = repo_subparser.add_parser(cmd, help=desc)
+                for flag, kwargs in l.get_repositoryarguments(r, cmd):
+                    cmd_parser.add_argument(flag, default=argparse.SUPPRESS, **kwargs)
                 cmd_parser.set_defaults(func=execute_repocommand, cmd=cmd, repo=r)
 
         for a in l.get_programs():
@@ -80,6 +86,9 @@ def main():
             prog_subparser = prog_parser.add_subparsers(help=a + ' Program Commands.')
             for cmd, desc in l.get_programcommands(a):
                 prog_parser = prog_subparser.add_parser(cmd, help=desc)
+                for flag, kwargs in l.get_programarguments(a, cmd):
+                    # les arguments absents ne sont pas transmis: le programme garde ses valeurs par défaut
+                    prog_parser.add_argument(flag, default=argparse.SUPPRESS, **kwargs)
                 prog_parser.set_defaults(func=execute_program, cmd=cmd, prog=a)
 
         for v in l.get_filterforvisualisations():
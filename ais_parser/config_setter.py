@@ -35,6 +35,7 @@ def gen_default_config(*args):
     default_config.set('aiscsv', 'path', aiscsv_directory)
     default_config.set('aiscsv', 'extensions', '.csv')
     default_config.set('aiscsv', 'unzip', 'True')
+    default_config.set('aiscsv', 'prefetch', '0')
 
     baddata_directory = os.path.join(os.getcwd(), 'baddata')
     if not os.path.exists(baddata_directory):
@@ -54,6 +55,18 @@ def gen_default_config(*args):
     default_config.set('aisdb', 'ro_user', 'test_ais')
     default_config.set('aisdb', 'ro_pass', 'test_ais')
     default_config.set('aisdb', 'postgis', 'yes')
+    # insertion en masse: 'insert' (INSERT ... VALUES), 'copy' ou 'copy_binary' (COPY ... FROM STDIN)
+    default_config.set('aisdb', 'bulk_mode', 'copy')
+    # partitionnement de ais_clean et ais_dirty par date: 'none', 'monthly' ou 'daily' (choisi avant create)
+    default_config.set('aisdb', 'partitioning', 'none')
+    # index des tables de messages: 'default' (B-tree), 'compact' (BRIN et composites) ou 'spatial' (compact et GiST)
+    default_config.set('aisdb', 'index_profile', 'default')
+    # reconstruction des index après un chargement: connexions en parallèle et paramètres de session
+    default_config.set('aisdb', 'index_workers', '1')
+    default_config.set('aisdb', 'maintenance_work_mem', '1GB')
+    default_config.set('aisdb', 'max_parallel_maintenance_workers', '2')
+    # localisation SIG de ais_extended: 'trigger' (par ligne), 'insert' (dans la requête) ou 'generated' (avant create)
+    default_config.set('aisdb', 'location_mode', 'trigger')
 
     # écriture dans le fichier
     with open('../ais_parser.conf', 'w') as config_file:
@@ -6,6 +6,7 @@ import time
 import numpy as np
 import pandas as pd
 import yaml
+from ais_parser import utils
 
 EXPORT_COMMANDS = [('run', 'Process Ais Data For Ploting on Map.')]
 
@@ -191,7 +192,7 @@ def read_data(csv_files, options, grid_params):
         ais_df = ais_df[usecols]
 
         # interprète les entrées de temps brutes comme des objets datetime et supprime la colonne d'origine
-        ais_df["DateTime"] = pd.to_datetime( ais_df["Complete_Sys_Date"], format="%d/%m/%Y %H:%M:%S")
+        ais_df["DateTime"] = utils.parse_sysdates(ais_df["Complete_Sys_Date"])
         ais_df.drop(columns="Complete_Sys_Date", inplace=True)
 
         ais_df["Longitude"] = pd.to_numeric(ais_df["Longitude"])
@@ -311,44 +312,19 @@ def write_data(trajectories, options, directories, grid_params):
 
     # réinitialise l'index maintenant que la manipulation de ce dataframe est terminée
     trajectories.reset_index(drop=True, inplace=True)
-    # crée une série de dataframes empilées, chaque dataframe représentant une transition d'état interpolée
-    sas = trajectories.groupby("MMSI").apply(
-        lambda x: get_action(x, options, grid_params)
-    )
-
-    if isinstance(
-            sas, pd.DataFrame
-    ):  # devient un DataFrame lorsque chaque trajectoire n'a qu'un seul triplet sas
-        print(sas)
-        sas = sas[0]
-
-    # merge Série de dictionnaires
-    ids = []
-    prevs = []
-    acts = []
-    curs = []
-    lons = []
-    lats = []
-
-    for traj in sas:
-        ids += traj["ID"]
-        prevs += traj["PREV"]
-        acts += traj["ACT"]
-        curs += traj["CUR"]
-        if options["append_coords"]:
-            lons += traj["Longitude"]
-            lats += traj["Latitude"]
+    # calcule en une fois les transitions d'état interpolées de toutes les trajectoires
+    sas = get_actions(trajectories, options, grid_params)
 
-    # préparer le dictionnaire final avec des listes construites et un nom de titre approprié
+    # préparer le dictionnaire final avec un nom de titre approprié
     sas_data = {
-        "sequence_id": ids,
-        "from_state_id": prevs,
-        "action_id": acts,
-        "to_state_id": curs,
+        "sequence_id": sas["ID"],
+        "from_state_id": sas["PREV"],
+        "action_id": sas["ACT"],
+        "to_state_id": sas["CUR"],
     }
     if options["append_coords"]:
-        sas_data["longitude"] = lons
-        sas_data["latitude"] = lats
+        sas_data["longitude"] = sas["Longitude"]
+        sas_data["latitude"] = sas["Latitude"]
 
     # écrit une nouvelle trame de données dans le fichier CSV final
     sas = pd.DataFrame(sas_data)
@@ -535,6 +511,119 @@ def get_action(traj, options, grid_params):
     return data_out
 
 
+def get_actions(trajectories, options, grid_params):
+    """Version vectorisée de `` get_action '' appliquée à toutes les trajectoires à la fois.
+
+    Les décalages de lignes et de colonnes de toutes les transitions sont calculés avec NumPy, puis chaque transition est
+    développée en ses étapes interpolées avec `` np.repeat '' (le nombre d'étapes d'une transition est connu d'avance:
+    `` max(|rel_row|, |rel_col|) '' avec les diagonales, `` |rel_row| + |rel_col| '' sans). Les actions arbitraires sont
+    données par `` spiral_action ''. Le résultat est identique à la concaténation des sorties de `` get_action '' pour
+    chaque trajectoire, dans l'ordre des identifiants.
+
+    Args:
+        trajectories (pandas.DataFrame): Toutes les entrées avec les colonnes `` ['MMSI', 'Longitude', 'Latitude', 'STATE'] '',
+            triées par `` MMSI '' (identifiant de trajectoire) puis par horodatage.
+        options (dict): les options de script spécifiées dans le fichier `` config_file ''.
+        grid_params (dict): Les paramètres de grille spécifiés dans le `` config_file ''.
+
+    Retour:
+        dict: Les colonnes (tableaux) des triplets état-action-état de toutes les trajectoires.
+    """
+    ids = trajectories["MMSI"].values.astype(np.int64)
+    states = trajectories["STATE"].values.astype(np.int64)
+    lon = trajectories["Longitude"].values
+    lat = trajectories["Latitude"].values
+    num_cols = grid_params["num_cols"]
+
+    # transitions entre deux lignes consécutives d'une même trajectoire
+    trans = np.flatnonzero(ids[:-1] == ids[1:])
+    prev_state = states[trans]
+    cur_state = states[trans + 1]
+    prev_row = prev_state // num_cols
+    prev_col = prev_state % num_cols
+    rel_row = cur_state // num_cols - prev_row
+    rel_col = cur_state % num_cols - prev_col
+    sign_row = np.sign(rel_row)
+    sign_col = np.sign(rel_col)
+    abs_row = np.abs(rel_row)
+    abs_col = np.abs(rel_col)
+
+    # nombre d'étapes de chaque transition, puis indice de chaque étape dans sa transition
+    if not options["interp_actions"]:
+        steps = np.ones(len(trans), dtype=np.int64)
+    elif options["allow_diag"]:
+        steps = np.maximum(abs_row, abs_col)
+    else:
+        steps = abs_row + abs_col
+    rep = np.repeat(np.arange(len(trans)), steps)
+    step = np.arange(len(rep)) - np.repeat(np.cumsum(steps) - steps, steps)
+
+    if not options["interp_actions"]:
+        # une seule action arbitraire par transition
+        step_prev = prev_state
+        step_cur = cur_state
+        acts = spiral_action(rel_col, rel_row)
+    else:
+        abs_row = abs_row[rep]
+        abs_col = abs_col[rep]
+        sign_row = sign_row[rep]
+        sign_col = sign_col[rep]
+        if options["allow_diag"]:
+            # chaque étape déplace d'une case sur chaque axe qui n'a pas encore atteint l'état actuel
+            rows_before = np.minimum(step, abs_row)
+            cols_before = np.minimum(step, abs_col)
+            move_row = np.where(step < abs_row, sign_row, 0)
+            move_col = np.where(step < abs_col, sign_col, 0)
+            # actions des 8 voisins, indexées par (signe de ligne + 1, signe de colonne + 1)
+            acts = np.array([[6, 7, 8], [5, -1, 1], [4, 3, 2]])[move_row + 1, move_col + 1]
+        else:
+            # l'axe le plus éloigné avance d'abord, puis colonnes et lignes alternent en commençant par une colonne
+            lead_row = abs_row > abs_col
+            lead = np.abs(abs_row - abs_col)
+            alternate = np.maximum(step - lead, 0)
+            rows_before = alternate // 2 + np.where(lead_row, np.minimum(step, lead), 0)
+            cols_before = (alternate + 1) // 2 + np.where(lead_row, 0, np.minimum(step, lead))
+            is_row = np.where(step < lead, lead_row, alternate % 2 == 1)
+            move_row = np.where(is_row, sign_row, 0)
+            move_col = np.where(is_row, 0, sign_col)
+            acts = np.where(is_row, np.where(sign_row > 0, 2, 4), np.where(sign_col > 0, 1, 3))
+        step_row = prev_row[rep] + sign_row * rows_before
+        step_col = prev_col[rep] + sign_col * cols_before
+        step_prev = step_row * num_cols + step_col
+        step_cur = (step_row + move_row) * num_cols + step_col + move_col
+
+    out_data = {
+        "ID": ids[trans][rep],
+        "PREV": step_prev,
+        "ACT": acts,
+        "CUR": step_cur,
+    }
+
+    if options["append_coords"]:
+        # coordonnées du milieu des états interpolés, coordonnées brutes pour la première étape de chaque transition
+        lons = np.round(grid_params["min_lon"] + grid_params["grid_len"] * (step_prev % num_cols + 0.5),
+                        options["prec_coords"])
+        lats = np.round(grid_params["min_lat"] + grid_params["grid_len"] * (step_prev // num_cols + 0.5),
+                        options["prec_coords"])
+        first = step == 0
+        lons[first] = lon[trans][rep[first]]
+        lats[first] = lat[trans][rep[first]]
+
+        # ajoute l'état final de chaque trajectoire comme sa propre ligne, après ses transitions
+        last = np.flatnonzero(np.append(ids[:-1] != ids[1:], len(ids) > 0))
+        order = np.argsort(np.concatenate([out_data["ID"], ids[last]]), kind="stable")
+        out_data = {
+            "ID": np.concatenate([out_data["ID"], ids[last]])[order],
+            "PREV": np.concatenate([step_prev, states[last]])[order],
+            "ACT": np.concatenate([acts, np.full(len(last), -1)])[order],
+            "CUR": np.concatenate([step_cur, np.full(len(last), -1)])[order],
+            "Longitude": np.concatenate([lons, lon[last]])[order],
+            "Latitude": np.concatenate([lats, lat[last]])[order],
+        }
+
+    return out_data
+
+
 def get_action_arb(row, options, grid_params):
     """Calcule une action arbitraire de l'état précédent à l'état actuel par rapport à l'état précédent.
 
@@ -554,13 +643,14 @@ def get_action_arb(row, options, grid_params):
         Ensuite, la position de l'état actuel par rapport à l'état précédent est `` rel_row = 0 '', `` rel_col = 2 ''. Notre action
         spirale ressemble alors à ceci:
 
-            15 14 13 12 11      15 14 13 12 11
-            16 4  3  2  10      16 4  3  2  10
-            17 5  0  1  9   ->  17 5  p  1  c
-            18 6  7  8  24      18 6  7  8  24
-            19 20 21 22 23      19 20 21 22 23
+            16 15 14 13 12      16 15 14 13 12
+            17 4  3  2  11      17 4  3  2  11
+            18 5  0  1  10  ->  18 5  p  1  c
+            19 6  7  8  9       19 6  7  8  9
+            20 21 22 23 24      20 21 22 23 24
 
-        Ainsi, cet algorithme renverra `` 9 '' comme action.
+        Ainsi, cet algorithme renverra `` 10 '' comme action. L'action est calculée directement par `` spiral_action '',
+        `` spiral_offset '' donne le décalage correspondant à une action.
 
     Args:
         row (pandas.Series): une ligne du DataFrame auquel la fonction est appliquée, contenant le numéro de trajectoire,
@@ -586,34 +676,8 @@ def get_action_arb(row, options, grid_params):
     rel_row = cur_row - prev_row
     rel_col = cur_col - prev_col
 
-    # routine simple pour calculer un ensemble d'actions en spirale
-    # la séquence définie par calque correspond au nombre total de carrés de grille dans chaque calque en spirale
-    action_num = x = y = i = 0
-    layer = (2 * i + 1) ** 2  # sets breakpoint for when to increment i
-    while not (x == rel_col and y == rel_row):
-        if action_num == layer - 1:
-            i += 1  # passer à la spirale suivante
-            x = i
-            layer = (2 * i + 1) ** 2  # calculer le point d'arrêt pour la prochaine spirale
-        elif (
-                x == i and y < i
-        ):  # traverse du début du calque au coin supérieur droit
-            y += 1
-        elif x > -i and y == i:  # traverse du coin supérieur droit au coin supérieur gauche
-            x -= 1
-        elif (
-                x == -i and y > -i
-        ): # traverse du coin supérieur gauche au coin inférieur gauche
-            y -= 1
-        elif (
-                x < i and y == -i
-        ):  # traverse du coin inférieur gauche au coin inférieur droit
-            x += 1
-        elif (
-                x == i and y < 0
-        ):  # traverse du coin inférieur gauche à la fin du calque (Layer)
-            y += 1
-        action_num += 1
+    # numéro de l'action en spirale, calculé sans parcourir la spirale
+    action_num = spiral_action(rel_col, rel_row)
 
     # prépare le dictionnaire de données final pour construire DataFrame
     out_data = {
@@ -631,6 +695,61 @@ def get_action_arb(row, options, grid_params):
     return out_data
 
 
+def spiral_action(rel_col, rel_row):
+    """Calcule l'action en spirale de `` get_action_arb '' sans parcourir la spirale, pour des entiers ou des tableaux.
+
+    La couche `` i = max(|rel_col|, |rel_row|) '' de la spirale commence à l'action `` (2i - 1) ** 2 '' en
+    `` (i, 1 - i) '', monte jusqu'au coin supérieur droit, puis longe les côtés haut, gauche et bas (`` 2i '' cases
+    chacun) jusqu'à `` (i, -i) '', action `` (2i + 1) ** 2 - 1 ''.
+
+    Args:
+        rel_col: décalage(s) de colonne de l'état actuel par rapport à l'état précédent.
+        rel_row: décalage(s) de ligne de l'état actuel par rapport à l'état précédent.
+
+    Retour:
+        Le(s) numéro(s) d'action, `` 0 '' pour une auto-transition.
+    """
+    x = np.asarray(rel_col, dtype=np.int64)
+    y = np.asarray(rel_row, dtype=np.int64)
+    i = np.maximum(np.abs(x), np.abs(y))
+    base = (2 * i - 1) ** 2
+    action = np.select(
+        [i == 0, (x == i) & (y > -i), y == i, x == -i],
+        [0, base + y + i - 1, base + 3 * i - 1 - x, base + 5 * i - 1 - y],
+        base + 7 * i - 1 + x,
+    )
+    if action.ndim == 0:
+        return int(action)
+    return action
+
+
+def spiral_offset(action):
+    """Fonction inverse de `` spiral_action '': décalage correspondant à une action en spirale, pour des entiers ou
+    des tableaux.
+
+    Args:
+        action: numéro(s) d'action en spirale (positifs ou nuls).
+
+    Retour:
+        tuple: Le(s) décalage(s) de colonne et de ligne `` (rel_col, rel_row) '' correspondant(s).
+    """
+    a = np.asarray(action, dtype=np.int64)
+    # racine carrée entière, corrigée des erreurs d'arrondi des grandes valeurs
+    r = np.floor(np.sqrt(a)).astype(np.int64)
+    r = np.where(r * r > a, r - 1, r)
+    r = np.where((r + 1) * (r + 1) <= a, r + 1, r)
+    # couche de l'action, puis côté de la couche et position le long de ce côté
+    i = (r + 1) // 2
+    k = a - (2 * i - 1) ** 2
+    side = k // np.maximum(2 * i, 1)
+    t = k - side * 2 * i
+    x = np.select([i == 0, side == 0, side == 1, side == 2], [0, i, i - 1 - t, -i], t - i + 1)
+    y = np.select([i == 0, side == 0, side == 1, side == 2], [0, t - i + 1, i, i - 1 - t], -i)
+    if x.ndim == 0:
+        return int(x), int(y)
+    return x, y
+
+
 def get_action_interp_with_diag(row, options, grid_params):
     """Calcule les actions prises à partir de l'état précédent pour atteindre l'état actuel, en interpolant si nécessaire.
 
@@ -108,6 +108,13 @@ class Loader:
         except AttributeError:
             return []
 
+    def get_repositoryarguments(self, repo_name, command):
+        """Renvoie une liste des arguments (drapeau, options argparse) acceptés par la commande du référentiel spécifié"""
+        try:
+            return self.repo_drivers[self.repo_config[repo_name]['type']].EXPORT_ARGUMENTS.get(command, [])
+        except AttributeError:
+            return []
+
     def get_programcommands(self, progname):
         """Renvoie une liste des commandes disponibles pour le programme spécifié"""
         try:
@@ -115,6 +122,13 @@ class Loader:
         except AttributeError:
             return []
 
+    def get_programarguments(self, progname, command):
+        """Renvoie une liste des arguments (drapeau, options argparse) acceptés par la commande du programme spécifié"""
+        try:
+            return self.programs[progname].EXPORT_ARGUMENTS.get(command, [])
+        except AttributeError:
+            return []
+
     def get_filterforvisualisationcommands(self, visname):
         """Renvoie une liste des commandes disponibles pour la visualisation"""
         try:
@@ -0,0 +1,154 @@
+"""Représentation en colonnes des messages AIS
+
+MessageBatch
+------------
+Lot de messages stocké colonne par colonne (tableaux NumPy et masques NULL),
+interchangeable avec la liste de dicts utilisée ailleurs (from_dicts, to_dicts).
+
+"""
+import datetime
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    logging.warn("No numpy found")
+    np = None
+
+
+class MessageBatch(object):
+    """Lot de messages en colonnes.
+
+    Chaque colonne est un tableau NumPy (int64, float64, datetime64[us] ou object) accompagné d'un masque
+    des valeurs NULL: un entier NULL ne coûte qu'un octet de masque, et un NaN reste distinct de NULL.
+    Le type d'une colonne est déduit de ses valeurs python: entiers, flottants, horodatages sans fuseau
+    horaire, sinon object. to_dicts restitue exactement les dicts d'origine.
+
+    Attributs
+    ---------
+    columns: liste des noms de colonnes, dans l'ordre
+    values: dict nom -> tableau des valeurs (valeur quelconque pour NULL)
+    nulls: dict nom -> masque booléen des valeurs NULL
+    """
+    __slots__ = ('columns', 'values', 'nulls')
+
+    def __init__(self, columns, values, nulls):
+        self.columns = list(columns)
+        self.values = values
+        self.nulls = nulls
+
+    @classmethod
+    def from_columns(cls, columns, data):
+        """Construit un lot à partir de colonnes de valeurs python (None pour NULL)"""
+        if np is None:
+            raise RuntimeError("Numpy not Found, Cannot Create a Message Batch")
+        values = {}
+        nulls = {}
+        for col, column in zip(columns, data):
+            values[col], nulls[col] = _to_array(column)
+        return cls(columns, values, nulls)
+
+    @classmethod
+    def from_rows(cls, rows, columns):
+        """Construit un lot à partir de tuples (par exemple des lignes de curseur) dans l'ordre de columns"""
+        data = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+        return cls.from_columns(columns, data)
+
+    @classmethod
+    def from_dicts(cls, rows, columns=None):
+        """Construit un lot à partir d'une liste de dicts, les colonnes par défaut sont celles du premier"""
+        if columns is None:
+            columns = list(rows[0].keys()) if len(rows) > 0 else []
+        return cls.from_columns(columns, [[row[col] for row in rows] for col in columns])
+
+    @classmethod
+    def concat(cls, batches):
+        """Concatène des lots ayant les mêmes colonnes"""
+        batches = list(batches)
+        columns = batches[0].columns
+        values = {}
+        nulls = {}
+        for col in columns:
+            arrays = [batch.values[col] for batch in batches]
+            if any(arr.dtype != arrays[0].dtype for arr in arrays):
+                # types différents (par exemple une colonne entièrement NULL): valeurs python
+                return cls.from_columns(columns, [[v for batch in batches for v in batch.column(col)]
+                                                  for col in columns])
+            values[col] = np.concatenate(arrays)
+            nulls[col] = np.concatenate([batch.nulls[col] for batch in batches])
+        return cls(columns, values, nulls)
+
+    def __len__(self):
+        if len(self.columns) == 0:
+            return 0
+        return len(self.nulls[self.columns[0]])
+
+    def __getitem__(self, key):
+        """batch['Latitude'] renvoie le tableau de valeurs d'une colonne; un masque booléen, une tranche ou
+        un tableau d'indices renvoie un nouveau lot avec les lignes sélectionnées"""
+        if isinstance(key, str):
+            return self.values[key]
+        return MessageBatch(self.columns, {col: arr[key] for col, arr in self.values.items()},
+                            {col: null[key] for col, null in self.nulls.items()})
+
+    @property
+    def nbytes(self):
+        """Taille des tableaux en octets (hors objets python des colonnes object)"""
+        return sum(arr.nbytes for arr in self.values.values()) + sum(null.nbytes for null in self.nulls.values())
+
+    def column(self, col):
+        """Valeurs python d'une colonne, None pour NULL"""
+        arr = self.values[col]
+        null = self.nulls[col]
+        values = arr.tolist()
+        if null.any():
+            for i in np.flatnonzero(null).tolist():
+                values[i] = None
+        return values
+
+    def floats(self, col):
+        """Colonne en float64, NaN pour NULL"""
+        arr = self.values[col]
+        if arr.dtype == object:
+            arr = np.array([np.nan if v is None else v for v in arr], dtype=np.float64)
+        else:
+            arr = arr.astype(np.float64)
+        return np.where(self.nulls[col], np.nan, arr)
+
+    def itertuples(self, columns=None):
+        """Génère un tuple de valeurs python par message, dans l'ordre de columns"""
+        if columns is None:
+            columns = self.columns
+        return zip(*[self.column(col) for col in columns])
+
+    def to_dicts(self):
+        """Liste de dicts (colonne, valeur), None pour NULL"""
+        return [dict(zip(self.columns, row)) for row in self.itertuples()]
+
+
+def _to_array(column):
+    # (valeurs, masque NULL) d'une colonne de valeurs python
+    null = np.array([v is None for v in column], dtype=bool)
+    present = [v for v in column if v is not None]
+    kinds = set(type(v) for v in present)
+    dtype = object
+    if len(present) == 0:
+        pass
+    elif kinds == {int}:
+        if -2 ** 63 <= min(present) and max(present) < 2 ** 63:
+            dtype = np.int64
+    elif kinds <= {float, np.float64}:
+        dtype = np.float64
+    elif kinds == {datetime.datetime} and all(v.tzinfo is None for v in present):
+        dtype = 'datetime64[us]'
+    if dtype is object:
+        arr = np.empty(len(column), dtype=object)
+        arr[:] = list(column)
+        return arr, null
+    if dtype is np.int64:
+        fill = 0
+    elif dtype is np.float64:
+        fill = np.nan
+    else:
+        fill = present[0]
+    return np.array([fill if v is None else v for v in column], dtype=dtype), null
@@ -1,24 +1,59 @@
 
 import os
+import io
 import csv
+import itertools
+import collections
 import logging
 import queue
 import threading
 import time
 import sys
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from xml.etree import ElementTree
 from ais_parser import utils
+from ais_parser.programs import imolister
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    logging.warn("No pandas found")
+    np = None
+    pd = None
 
 EXPORT_COMMANDS = [('run', 'Parse Messages From CSV into The PGSql Database.')]
 # Répertoire utilisé pour l'entrée dans le programme
 INPUTS = ["aiscsv"]
 # Répertoires utilisés pour la sortie du programme
 OUTPUTS = ["aisdb", "baddata"]
+# Arguments optionnels des commandes, ajoutés à la ligne de commande
+EXPORT_ARGUMENTS = {'run': [('--workers', {'type': int,
+                                           'help': 'Number of Processes Parsing CSV Files (Default 1).'}),
+                             ('--decoder', {'choices': ['rows', 'columnar'],
+                                            'help': 'CSV Decoder: Row by Row (Default) or Columnar (pandas).'}),
+                             ('--batch-size', {'type': int,
+                                               'help': 'Number of Rows Inserted per Batch (Default 10000).'}),
+                             ('--max-latency', {'type': float,
+                                                'help': 'Max Seconds a Row Waits Before Being Flushed (Default 2).'}),
+                             ('--checkpoint-lines', {'type': int,
+                                                     'help': 'Commit a Resume Point Every N Lines of a File '
+                                                             '(Default 1000000, 0 to Disable).'}),
+                             ('--imolist', {'action': 'store_true',
+                                            'help': 'Update imo_list While Parsing Instead of a Separate Pass.'})]}
+
+# nombre de lignes csv envoyées à chaque tâche d'analyse
+CHUNK_LINES = 50000
+# politique d'écriture: taille cible des lots, attente maximale d'une ligne (s) et nombre de lots en file
+BATCH_SIZE = 10000
+MAX_LATENCY = 2.0
+QUEUE_BATCHES = 8
+# nombre de lignes d'un fichier entre deux points de reprise
+CHECKPOINT_LINES = 1000000
 
 
 def analyze_timestamp(s):
-    return datetime.strptime(s, '%d/%m/%Y %H:%M:%S')
+    return utils.cached_parse_sysdate(s)
 
 
 def int_or_null(s):
@@ -186,150 +221,422 @@ def get_data_source(name):
         return 0
 
 
-def run(inp, out, dropindices=True, source=0):
+class BatchWriter(threading.Thread):
+    """Étage d'écriture d'une table: les lignes sont regroupées en lots d'environ
+    batch_size lignes, une ligne n'attendant jamais plus de max_latency secondes
+    avant d'être envoyée. La file de lots est bornée, l'analyse est donc freinée
+    lorsque la base de données n'arrive pas à suivre.
+
+    L'âge des lignes en attente est celui de la plus ancienne d'entre elles; il est
+    vérifié à chaque ajout et par le thread d'écriture lui-même, qui envoie un lot
+    incomplet trop ancien même si aucune nouvelle ligne n'arrive.
+
+    Chaque lot est inséré dans un point de sauvegarde; en cas d'erreur le lot est
+    coupé en deux et réessayé, seules les lignes fautives sont perdues.
+    """
+
+    def __init__(self, table, lock, batch_size=BATCH_SIZE, max_latency=MAX_LATENCY, max_batches=QUEUE_BATCHES):
+        super(BatchWriter, self).__init__(daemon=True)
+        self.table = table
+        # verrou partagé par les étages utilisant la même connexion
+        self.lock = lock
+        self.batch_size = max(1, batch_size)
+        self.max_latency = max_latency
+        self.queue = queue.Queue(maxsize=max_batches)
+        # lignes en attente d'un lot complet, partagées entre le producteur et le thread d'écriture,
+        # avec les heures d'arrivée de chaque ajout (heure, nombre de lignes) dans l'ordre
+        self.pending = []
+        self.arrivals = collections.deque()
+        self.pending_lock = threading.Lock()
+        # compteurs
+        self.rows = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.write_time = 0.0
+
+    @property
+    def pending_since(self):
+        """Heure d'arrivée de la plus ancienne ligne en attente, ou None."""
+        return self.arrivals[0][0] if len(self.arrivals) > 0 else None
+
+    def put(self, rows):
+        """Ajoute des lignes, les lots complets sont envoyés à l'étage d'écriture."""
+        if len(rows) == 0:
+            return
+        with self.pending_lock:
+            now = time.time()
+            self.pending.extend(rows)
+            self.arrivals.append([now, len(rows)])
+            full = len(self.pending) - len(self.pending) % self.batch_size
+            self._send(self._take(len(self.pending) if now - self.pending_since >= self.max_latency else full))
+
+    def flush(self):
+        """Envoie les lignes en attente et attend que tous les lots soient écrits."""
+        with self.pending_lock:
+            self._send(self._take(len(self.pending)))
+        self.queue.join()
+
+    def discard(self):
+        """Abandonne les lignes en attente et attend la fin des lots déjà envoyés."""
+        with self.pending_lock:
+            self.pending = []
+            self.arrivals.clear()
+        self.queue.join()
+
+    def _take(self, n):
+        # retire les n premières lignes en attente, découpées en lots; les heures d'arrivée des lignes
+        # restantes sont conservées
+        if n == 0:
+            return []
+        batches = [self.pending[i:min(i + self.batch_size, n)] for i in range(0, n, self.batch_size)]
+        self.pending = self.pending[n:]
+        while n > 0:
+            if self.arrivals[0][1] <= n:
+                n = n - self.arrivals.popleft()[1]
+            else:
+                self.arrivals[0][1] = self.arrivals[0][1] - n
+                n = 0
+        return batches
+
+    def _send(self, batches):
+        # appelé avec pending_lock: les lots sont mis en file dans l'ordre d'arrivée des lignes
+        for batch in batches:
+            self.queue.put(batch)
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _expire(self):
+        # appelé par le thread d'écriture lorsque la file est vide: envoie les lignes en attente si la plus
+        # ancienne a atteint max_latency, renvoie le délai avant la prochaine vérification
+        if not self.pending_lock.acquire(blocking=False):
+            # le producteur ajoute des lignes (et attend peut-être de la place dans la file)
+            return 0.01
+        try:
+            if not self.queue.empty():
+                return 0.0
+            since = self.pending_since
+            if since is None:
+                return self.max_latency
+            age = time.time() - since
+            if age < self.max_latency:
+                return self.max_latency - age
+            # moins de batch_size lignes en attente: un seul lot, la file vide a de la place
+            self._send(self._take(len(self.pending)))
+        finally:
+            self.pending_lock.release()
+        return self.max_latency
+
+    def run(self):
+        timeout = self.max_latency
+        while True:
+            try:
+                batch = self.queue.get(timeout=max(timeout, 0.001))
+            except queue.Empty:
+                timeout = self._expire()
+                continue
+            try:
+                start = time.time()
+                with self.lock:
+                    self._insert(batch)
+                self.write_time = self.write_time + time.time() - start
+                self.batches = self.batches + 1
+            except Exception as e:
+                # la connexion elle-même est en défaut, le lot est perdu
+                logging.warning("Error Writing Batch of %d Rows to %s: %s", len(batch), self.table.name, repr(e))
+                self.failed = self.failed + len(batch)
+            finally:
+                self.queue.task_done()
+            timeout = self._expire() if self.queue.empty() else self.max_latency
+
+    def _insert(self, rows):
+        with self.table.db.conn.cursor() as cur:
+            cur.execute("SAVEPOINT batch_writer")
+            try:
+                self.table.insert_rowsbatch(rows)
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_writer")
+                if len(rows) == 1:
+                    logging.warning("Error Inserting Row into %s: %s", self.table.name, repr(e))
+                    self.failed = self.failed + 1
+                else:
+                    # couper le lot en deux pour isoler les lignes fautives
+                    half = len(rows) // 2
+                    self._insert(rows[:half])
+                    self._insert(rows[half:])
+            else:
+                self.rows = self.rows + len(rows)
+            cur.execute("RELEASE SAVEPOINT batch_writer")
+
+    def report(self):
+        rate = self.rows / self.write_time if self.write_time > 0 else 0.0
+        return "Writer %s: %d Rows in %d Batches, %.0f Rows/s, %d Failed Rows, Queue Depth %d (Max %d)" % (
+            self.table.name, self.rows, self.batches, rate, self.failed, self.queue.qsize(), self.max_depth)
+
+
+class ImoAggregator(object):
+    """Intervalles (first_seen, last_seen) des paires (mmsi, imo_number) vues pendant l'analyse, comme les agrège
+    imolister: tous les messages propres et les messages sales de type 5.
+
+    Les paires sont fusionnées dans imo_list (flush) dans la transaction qui valide les lignes correspondantes,
+    à chaque point de reprise et à la fin de chaque fichier: seule la variation depuis la dernière fusion est
+    gardée en mémoire.
+    """
+
+    def __init__(self):
+        self.pairs = {}
+        self.merged = 0
+
+    def add(self, rows, static_only=False):
+        pairs = self.pairs
+        for row in rows:
+            mmsi = row[MMSI]
+            imo = row[IMO]
+            # imo_list.mmsi et imo_list.imo_number sont des integer: les lignes sales hors de cet intervalle, que
+            # l'insertion dans ais_dirty rejette aussi, sont ignorées
+            if mmsi is None or not -2 ** 31 <= mmsi < 2 ** 31:
+                continue
+            if imo is not None and not -2 ** 31 <= imo < 2 ** 31:
+                continue
+            if static_only and row[MESSAGE_TYPE] != 5:
+                continue
+            ts = row[TIME]
+            if ts is None:
+                continue
+            key = (mmsi, imo)
+            interval = pairs.get(key)
+            if interval is None:
+                pairs[key] = (ts, ts)
+            elif ts < interval[0]:
+                pairs[key] = (ts, interval[1])
+            elif ts > interval[1]:
+                pairs[key] = (interval[0], ts)
+
+    def flush(self, db):
+        """Fusionne les paires en attente dans imo_list, sans valider la transaction."""
+        if len(self.pairs) == 0:
+            return
+        imolister.merge_imo_pairs(db, self.pairs)
+        self.merged = self.merged + len(self.pairs)
+        self.pairs = {}
+
+    def discard(self):
+        """Abandonne les paires en attente (transaction annulée)."""
+        self.pairs = {}
+
+
+def run(inp, out, dropindices=True, source=0, workers=1, decoder='rows', batch_size=BATCH_SIZE,
+        max_latency=MAX_LATENCY, checkpoint_lines=CHECKPOINT_LINES, imolist=False):
 
     files = inp['aiscsv']
     db = out['aisdb']
     log = out['baddata']
 
+    if decoder == 'columnar' and pd is None:
+        raise RuntimeError("Pandas not Found, Cannot Use the Columnar Decoder")
+
     # supprimer des index pour une insertion plus rapide
     if dropindices:
         db.clean.drop_indices()
         db.dirty.drop_indices()
 
-    def sqlworker(q, table):
-
-        while True:
-            msgs = [q.get()]
-            while not q.empty():
-
-                msgs.append(q.get(timeout=0.5))
-
-            n = len(msgs)
-            if n > 0:
-                try:
-                    table.insert_rowsbatch(msgs)
-                except Exception as e:
-                    logging.warning("Error Executing Query: " + repr(e))
-            # marquer cette tâche comme terminée
-            for _ in range(n):
-                q.task_done()
-
-    # file d'attente pour les messages à insérer dans la base de données
-    dirtyq = queue.Queue(maxsize=1000000)
-    cleanq = queue.Queue(maxsize=1000000)
-    # configurer les threads de pipeline de traitement
-    clean_thread = threading.Thread(target=sqlworker, daemon=True,
-                                    args=(cleanq, db.clean))
-    dirty_thread = threading.Thread(target=sqlworker, daemon=True,
-                                    args=(dirtyq, db.dirty))
-    dirty_thread.start()
-    clean_thread.start()
+    # processus d'analyse des fichiers csv, les lignes validées reviennent au processus principal;
+    # le pool est créé avant les threads d'écriture et ses processus n'héritent pas de la connexion
+    pool = None
+    if workers > 1:
+        logging.info("Parsing CSV Files With %d Processes", workers)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=utils.process_context())
+
+    # étages d'écriture, un par table, partageant la connexion à la base de données
+    lock = threading.Lock()
+    clean_writer = BatchWriter(db.clean, lock, batch_size, max_latency)
+    dirty_writer = BatchWriter(db.dirty, lock, batch_size, max_latency)
+    dirty_writer.start()
+    clean_writer.start()
+    # agrégation de imo_list pendant l'analyse
+    imo_aggregator = ImoAggregator() if imolist else None
+
+    # points de reprise à l'intérieur des fichiers, si la table existe
+    checkpoints = db.checkpoints.status() >= 0
+    if not checkpoints:
+        logging.warning("Table " + db.checkpoints.name + " Not Found, Run 'update' to Enable Resumable Parsing.")
+
+    def checkpoint(state):
+        # toutes les lignes analysées avant le point de reprise sont écrites dans la même transaction
+        dirty_writer.flush()
+        clean_writer.flush()
+        if imo_aggregator is not None:
+            imo_aggregator.flush(db)
+        db.set_checkpoint(state)
+        db.conn.commit()
+        logging.info("Checkpoint " + state['filename'] + " at Line %d", state['line_offset'])
 
     start = time.time()
 
-    for fp, name, ext in files.iterfiles():
-        # vérifier si nous avons déjà analysé ce fichier
-        with db.conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM " + db.sources.name +
-                        " WHERE filename = %s AND source = %s",
-                        [name, source])
-            if cur.fetchone()[0] > 0:
-                logging.info("Already Parsed " + name + ", Skipping...")
-                continue
+    # fichiers déjà analysés, ignorés avant d'être ouverts ou décompressés
+    parsed = db.get_parsed_files(source)
+    logging.info("%d Files Already Parsed for Source %d", len(parsed), source)
+
+    def skip(name, ext):
+        if name in parsed:
+            logging.info("Already Parsed " + name + ", Skipping...")
+            return True
+        return False
+
+    for fp, name, ext in files.iterfiles(skip=skip):
+        # un fichier de même nom a pu être analysé depuis qu'il a été lu à l'avance
+        if name in parsed:
+            logging.info("Already Parsed " + name + ", Skipping...")
+            continue
 
-        # analyser le fichier
+        # analyser le fichier, en reprenant au dernier point de reprise
         try:
             log_path = os.path.join(log.root, os.path.basename(name))
-            invalid_ctr, clean_ctr, dirty_ctr, duration = analyze_file(fp, name, ext, log_path, cleanq, dirtyq,
-                                                                       source=source)
-            dirtyq.join()
-            cleanq.join()
+            resume = db.get_checkpoint(name, source) if checkpoints else None
+            invalid_ctr, clean_ctr, dirty_ctr, duration = analyze_file(fp, name, ext, log_path,
+                                                                       clean_writer, dirty_writer,
+                                                                       source=source, pool=pool,
+                                                                       max_pending=2 * workers, decoder=decoder,
+                                                                       checkpoint=checkpoint if checkpoints else None,
+                                                                       checkpoint_lines=checkpoint_lines,
+                                                                       resume=resume, imolist=imo_aggregator)
+            dirty_writer.flush()
+            clean_writer.flush()
+            if imo_aggregator is not None:
+                imo_aggregator.flush(db)
             db.sources.insert_row({'filename': name,
                                    'ext': ext,
                                    'invalid': invalid_ctr,
                                    'clean': clean_ctr,
                                    'dirty': dirty_ctr,
                                    'source': source})
+            if checkpoints:
+                db.clear_checkpoint(name, source)
             db.conn.commit()
+            parsed.add(name)
             logging.info("Completed " + name +
                          ": %d Clean, %d Dirty, %d Invalid Messages, %fs",
                          clean_ctr, dirty_ctr, invalid_ctr, duration)
+            logging.info(clean_writer.report())
+            logging.info(dirty_writer.report())
         except RuntimeError as error:
             logging.warn("Error Parsing File %s: %s", name, repr(error))
+            # abandonner les lignes de ce fichier encore en attente avant d'annuler la transaction,
+            # les lignes écrites avant le dernier point de reprise sont conservées
+            dirty_writer.discard()
+            clean_writer.discard()
+            if imo_aggregator is not None:
+                imo_aggregator.discard()
             db.conn.rollback()
 
+    if pool is not None:
+        pool.shutdown()
+
     # attendre la fin des tâches en file d'attente
-    dirtyq.join()
-    cleanq.join()
+    dirty_writer.flush()
+    clean_writer.flush()
     db.conn.commit()
 
     logging.info("Parsing Complete, Time Elapsed = %fs", time.time() - start)
+    if imo_aggregator is not None:
+        logging.info("Merged %d mmsi, imo_number Pairs Into imo_list While Parsing", imo_aggregator.merged)
 
     if dropindices:
         start = time.time()
         logging.info("Rebuilding Table Indices...")
-        db.clean.create_indices()
-        db.dirty.create_indices()
+        errors = db.build_indices([db.clean, db.dirty])
+        if len(errors) > 0:
+            logging.error("Indices Not Built: %s", ", ".join(errors))
         logging.info("Finished Building Indices, Time Elapsed = %fs",
                      time.time() - start)
 
 
-def analyze_file(fp, name, ext, baddata_logfile, cleanq, dirtyq, source=0):
+def analyze_file(fp, name, ext, baddata_logfile, cleanq, dirtyq, source=0, pool=None, max_pending=8,
+                 decoder='rows', checkpoint=None, checkpoint_lines=CHECKPOINT_LINES, resume=None, imolist=None):
+    """Analyse un fichier et envoie les lignes propres et sales aux files cleanq et dirtyq.
+
+    Avec imolist (un ImoAggregator), les paires (mmsi, imo_number) des lignes envoyées y sont aussi agrégées.
+
+    Toutes les checkpoint_lines lignes (ou messages xml), checkpoint est appelé avec l'état de l'analyse:
+    le nombre de lignes lues, les compteurs et la taille du journal des erreurs. Avec resume (un état
+    enregistré), l'analyse reprend après les lignes déjà lues et le journal des erreurs est complété."""
 
     filestart = time.time()
-    logging.info("Parsing " + name)
 
-    # ouvrir le fichier csv du journal des erreurs et écrire l'en-tête
-    with open(baddata_logfile, 'w') as errorlog:
+    # compteurs de messages
+    line_offset = 0
+    clean_ctr = 0
+    dirty_ctr = 0
+    invalid_ctr = 0
+    log_size = 0
+    if resume is not None:
+        line_offset = resume['line_offset']
+        log_size = resume['log_size']
+        clean_ctr = resume['clean']
+        dirty_ctr = resume['dirty']
+        invalid_ctr = resume['invalid']
+        logging.info("Resuming " + name + " at Line %d", line_offset)
+    else:
+        logging.info("Parsing " + name)
+
+    # ouvrir le fichier csv du journal des erreurs, à la reprise il est tronqué au dernier point de reprise
+    with open(baddata_logfile, 'a' if line_offset > 0 else 'w') as errorlog:
+        if line_offset > 0:
+            errorlog.truncate(log_size)
         logwriter = csv.writer(errorlog, delimiter=';', quotechar='"')
 
-        # compteurs de messages
-        clean_ctr = 0
-        dirty_ctr = 0
-        invalid_ctr = 0
+        # nombre de lignes de chaque bloc, dans l'ordre des résultats
+        sizes = collections.deque()
+
+        def counted(chunks, size):
+            for chunk in chunks:
+                sizes.append(size(chunk))
+                yield chunk
 
         # Sélectionnez un itérateur de fichier basé sur l'extension de fichier
         if ext == '.csv':
-            iterator = readcsv
+            # les fichiers csv sont découpés en blocs de lignes, analysés ici ou dans le pool de processus
+            chunks = counted(iterchunks(fp, skip=line_offset), lambda chunk: len(chunk[1]))
+            if pool is None:
+                results = (analyze_chunk(header, lines, source, decoder) for header, lines in chunks)
+            else:
+                results = imap_chunks(pool, chunks, source, max_pending, decoder)
         elif ext == '.xml':
-            iterator = readxml
+            chunks = counted(iterrecords(itertools.islice(readxml(fp), line_offset, None)), len)
+            results = (_split_rows(analyze_rows(records, source)) for records in chunks)
         else:
             raise RuntimeError("Cannot Parse File With Extension %s" % ext)
 
         # déduire la source de données à partir du nom de fichier
         # source = get_data_source(name)
 
-        # analyser et itérer les lignes du fichier courant
-        for row in iterator(fp):
-            converted_row = {}
-            try:
-                # analyser les données brutes
-                converted_row = analyze_raw_row(row)
-                converted_row['source'] = source
-            except ValueError as e:
-                # données non valides dans la ligne. Écriture dans le journal des erreurs
-                if not 'raw' in row:
-                    row['raw'] = [row[c] for c in AIS_CSV_COLUMNS]
-                logwriter.writerow(row['raw'] + ["{}".format(e)])
-                invalid_ctr = invalid_ctr + 1
-                continue
-            except KeyError:
-                # données manquantes dans la ligne.
-                if not 'raw' in row:
-                    row['raw'] = [row[c] for c in AIS_CSV_COLUMNS]
-                logwriter.writerow(row['raw'] + ["Bad Row Length"])
-                invalid_ctr = invalid_ctr + 1
-                continue
-
-            # valider la ligne analysée et l'ajouter à la file d'attente appropriée
-            try:
-                validated_row = validate_row(converted_row)
-                cleanq.put(validated_row)
-                clean_ctr = clean_ctr + 1
-            except ValueError:
-                dirtyq.put(converted_row)
-                dirty_ctr = dirty_ctr + 1
+        # ajouter les lots de lignes analysées à la file d'attente appropriée
+        since_checkpoint = 0
+        for clean_rows, dirty_rows, invalid_rows in results:
+            cleanq.put(clean_rows)
+            dirtyq.put(dirty_rows)
+            if imolist is not None:
+                imolist.add(clean_rows)
+                imolist.add(dirty_rows, static_only=True)
+            # données non valides. Écriture dans le journal des erreurs
+            logwriter.writerows(invalid_rows)
+            clean_ctr = clean_ctr + len(clean_rows)
+            dirty_ctr = dirty_ctr + len(dirty_rows)
+            invalid_ctr = invalid_ctr + len(invalid_rows)
+
+            lines = sizes.popleft()
+            line_offset = line_offset + lines
+            since_checkpoint = since_checkpoint + lines
+            if checkpoint is not None and checkpoint_lines > 0 and since_checkpoint >= checkpoint_lines:
+                errorlog.flush()
+                checkpoint({'filename': name,
+                            'ext': ext,
+                            'source': source,
+                            'line_offset': line_offset,
+                            'log_size': errorlog.tell(),
+                            'invalid': invalid_ctr,
+                            'clean': clean_ctr,
+                            'dirty': dirty_ctr})
+                since_checkpoint = 0
 
     if invalid_ctr == 0:
         os.remove(baddata_logfile)
@@ -337,31 +644,273 @@ def analyze_file(fp, name, ext, baddata_logfile, cleanq, dirtyq, source=0):
     return (invalid_ctr, clean_ctr, dirty_ctr, time.time() - filestart)
 
 
-def readcsv(fp):
-    # correctif pour une erreur de grand champ. Spécifiez la taille maximale du champ à la valeur int convertible maximale.
-    # source: http://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
-    max_int = sys.maxsize
-    decrement = True
-    while decrement:
-        # diminuer la valeur max_int d'un facteur 10
-        # tant que l'OverflowError se produit.
-        decrement = False
+# statuts d'une ligne analysée, index dans le tuple renvoyé par analyze_chunk
+CLEAN = 0
+DIRTY = 1
+INVALID = 2
+
+
+def analyze_rows(iterator, source=0):
+    """Analyse et valide les lignes brutes, génère des paires (statut, ligne).
+
+    Les lignes non valides sont renvoyées sous la forme de la ligne brute suivie du message d'erreur,
+    prêtes à être écrites dans le journal des erreurs."""
+    for row in iterator:
+        converted_row = {}
         try:
-            csv.field_size_limit(max_int)
-        except OverflowError:
-            max_int = int(max_int / 10)
-            decrement = True
+            # analyser les données brutes
+            converted_row = analyze_raw_row(row)
+            converted_row['source'] = source
+        except ValueError as e:
+            # données non valides dans la ligne.
+            if not 'raw' in row:
+                row['raw'] = [row[c] for c in AIS_CSV_COLUMNS]
+            yield INVALID, row['raw'] + ["{}".format(e)]
+            continue
+        except KeyError:
+            # données manquantes dans la ligne.
+            if not 'raw' in row:
+                row['raw'] = [row[c] for c in AIS_CSV_COLUMNS]
+            yield INVALID, row['raw'] + ["Bad Row Length"]
+            continue
+
+        # valider la ligne analysée
+        try:
+            validated_row = validate_row(converted_row)
+        except ValueError:
+            yield DIRTY, converted_row
+            continue
+        yield CLEAN, validated_row
+
+
+def analyze_chunk(header, lines, source=0, decoder='rows'):
+    """Analyse un bloc de lignes csv (précédé de la ligne d'en-tête).
+
+    Exécutée dans les processus du pool: renvoie les listes de lignes propres, sales et non valides."""
+    if decoder == 'columnar':
+        return decode_chunk(header, lines, source)
+    return _split_rows(analyze_rows(readcsv(io.StringIO(header + ''.join(lines))), source))
+
+
+def _split_rows(analyzed_rows):
+    # répartir les paires (statut, ligne) en listes de lignes propres, sales et non valides
+    results = ([], [], [])
+    for status, row in analyzed_rows:
+        results[status].append(row)
+    return results
+
+
+def iterchunks(fp, chunk_lines=CHUNK_LINES, skip=0):
+    """Découpe un fichier csv en blocs de lignes. Renvoie un générateur de paires (en-tête, lignes).
+
+    Les skip premières lignes après l'en-tête (déjà analysées) sont ignorées."""
+    header = fp.readline()
+    if skip > 0:
+        collections.deque(itertools.islice(fp, skip), maxlen=0)
+    while True:
+        lines = list(itertools.islice(fp, chunk_lines))
+        if len(lines) == 0:
+            return
+        # un champ entre guillemets peut contenir un saut de ligne: on complète le bloc
+        # jusqu'à ce que le nombre de guillemets soit pair
+        quotes = ''.join(lines).count('"')
+        while quotes % 2 == 1:
+            line = fp.readline()
+            if len(line) == 0:
+                break
+            lines.append(line)
+            quotes = quotes + line.count('"')
+        yield header, lines
+
+
+def iterrecords(records, chunk_lines=CHUNK_LINES):
+    """Regroupe les messages (xml) en blocs de chunk_lines messages."""
+    while True:
+        chunk = list(itertools.islice(records, chunk_lines))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def imap_chunks(pool, chunks, source=0, max_pending=8, decoder='rows'):
+    """Soumet les blocs au pool de processus et renvoie les résultats dans l'ordre du fichier.
+
+    Le nombre de blocs en cours est limité à ``max_pending`` pour que la mémoire reste bornée."""
+    # le chargeur importe ce programme sous le nom 'aisparser': les processus du pool retrouvent
+    # analyze_chunk par le nom complet du module
+    from ais_parser.programs import aisparser
+    pending = collections.deque()
+    try:
+        for header, lines in chunks:
+            pending.append(pool.submit(aisparser.analyze_chunk, header, lines, source, decoder))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# fonctions de conversion et type NumPy de chaque colonne pour le décodeur en colonnes
+COLUMN_CONVERTERS = [(MMSI, int_or_null, np.int64 if np else None),
+                     (TIME, analyze_timestamp, object),
+                     (MESSAGE_TYPE, int_or_null, np.int64 if np else None),
+                     (NAV_STATUS, int_or_null, np.int64 if np else None),
+                     (SOG, float_or_null, np.float64 if np else None),
+                     (LONGITUDE, float_or_null, np.float64 if np else None),
+                     (LATITUDE, float_or_null, np.float64 if np else None),
+                     (COG, float_or_null, np.float64 if np else None),
+                     (HEADING, float_or_null, np.float64 if np else None),
+                     (IMO, int_or_null, np.int64 if np else None),
+                     (DRAUGHT, float_or_null, np.float64 if np else None),
+                     (DEST, longstring, object),
+                     (VESSEL_NAME, longstring, object),
+                     (SHIP_TYPE, int_or_null, np.int64 if np else None),
+                     (ETA_MONTH, int_or_null, np.int64 if np else None),
+                     (ETA_DAY, int_or_null, np.int64 if np else None),
+                     (ETA_HOUR, int_or_null, np.int64 if np else None),
+                     (ETA_MINUTE, int_or_null, np.int64 if np else None)]
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def decode_chunk(header, lines, source=0):
+    """Décodeur en colonnes d'un bloc de lignes csv, équivalent à analyze_rows(readcsv(...)).
+
+    Chaque colonne est factorisée (pandas) et seules ses valeurs distinctes sont converties, avec les
+    mêmes fonctions que analyze_raw_row. Les règles de validate_row sont ensuite appliquées comme des
+    masques booléens. Les lignes dont une valeur ne peut pas être convertie (ou dépasse un entier 64 bits)
+    et les lignes de mauvaise longueur passent par analyze_rows, ce qui garantit exactement les mêmes
+    lignes propres, sales et non valides que le décodeur ligne par ligne.
+
+    Renvoie les listes de lignes propres, sales et non valides, dans l'ordre du fichier."""
+    _set_field_size_limit()
+    indices, n_cols = _header_indices(header)
+    try:
+        rows = list(csv.reader(io.StringIO(''.join(lines)), delimiter=';', quotechar='"'))
+    except csv.Error as e:
+        raise RuntimeError(e)
+
+    good = [i for i, row in enumerate(rows) if len(row) == n_cols]
+    n = len(good)
+    if n == len(rows):
+        fields = list(zip(*rows))
+    else:
+        fields = list(zip(*[rows[i] for i in good]))
+
+    # conversion des colonnes, les lignes en échec seront analysées ligne par ligne
+    fallback = np.zeros(n, dtype=bool)
+    values = {}
+    nulls = {}
+    for col, convert, dtype in COLUMN_CONVERTERS:
+        raw = fields[indices[col]] if n > 0 else ()
+        values[col], nulls[col], failed = _decode_column(raw, convert, dtype)
+        fallback |= failed
+
+    # règles de validate_row
+    mmsi = values[MMSI]
+    msg_type = values[MESSAGE_TYPE]
+    lon = values[LONGITUDE]
+    lat = values[LATITUDE]
+    valid = ~nulls[MMSI] & (((mmsi >= 100000000) & (mmsi <= 999999999)) |
+                            ((mmsi >= -99999999) & (mmsi <= -10000000)))
+    valid &= ~nulls[MESSAGE_TYPE] & (msg_type >= 1) & (msg_type <= 27)
+    valid &= nulls[IMO] | _valid_imo_mask(values[IMO])
+    contains_lat_lon = ~nulls[MESSAGE_TYPE] & np.isin(msg_type, list(CONTAINS_LAT_LON))
+    with np.errstate(invalid='ignore'):
+        valid_position = ~nulls[LONGITUDE] & ~nulls[LATITUDE] & (lon >= -180) & (lon <= 180) & \
+            (lat >= -90) & (lat <= 90)
+        clean = valid & (~contains_lat_lon | valid_position)
+        # lignes propres: (lat, lon) à None sans position, les autres colonnes non valides à None
+        set_null = {
+            LONGITUDE: clean & ~contains_lat_lon,
+            LATITUDE: clean & ~contains_lat_lon,
+            NAV_STATUS: clean & ~np.isin(values[NAV_STATUS], list(utils.VALID_NAVIGATIONAL_STATUSES)),
+            SOG: clean & ~((values[SOG] >= 0) & (values[SOG] <= 102.2)),
+            COG: clean & ~((values[COG] >= 0) & (values[COG] < 360)),
+            HEADING: clean & ~(((values[HEADING] >= 0) & (values[HEADING] < 360)) | (values[HEADING] == 511))
+        }
+
+    # colonnes de valeurs python, None pour NULL
+    arrays = []
+    for col, _, dtype in COLUMN_CONVERTERS:
+        arr = values[col].astype(object)
+        null = nulls[col]
+        if col in set_null:
+            null = null | set_null[col]
+        arr[null] = None
+        arrays.append(arr)
+    keys = AIS_CSV_COLUMNS + ['source']
+
+    results = ([], [], [])
+    pairs = ([], [], [])
+    for status, mask in ((CLEAN, clean & ~fallback), (DIRTY, ~clean & ~fallback)):
+        selected = [arr[mask] for arr in arrays]
+        rows_out = [dict(zip(keys, vals)) for vals in zip(*selected, itertools.repeat(source))]
+        if n == len(rows) and not fallback.any():
+            results[status].extend(rows_out)
+        else:
+            pairs[status].extend(zip(np.array(good)[mask].tolist(), rows_out))
+    if n == len(rows) and not fallback.any():
+        return results
+
+    # lignes de mauvaise longueur ou en échec de conversion: analyse ligne par ligne
+    slow = set(i for i, row in enumerate(rows) if len(row) != n_cols)
+    slow.update(np.array(good)[fallback].tolist())
+    for i in sorted(slow):
+        row = rows[i]
+        rowsubset = {'raw': row}
+        if len(row) == n_cols:
+            for col in AIS_CSV_COLUMNS:
+                rowsubset[col] = row[indices[col]]
+        status, converted_row = next(analyze_rows([rowsubset], source))
+        pairs[status].append((i, converted_row))
+    for status in (CLEAN, DIRTY, INVALID):
+        pairs[status].sort(key=lambda pair: pair[0])
+        results[status].extend(row for _, row in pairs[status])
+    return results
+
+
+def _decode_column(raw, convert, dtype):
+    # convertit les valeurs distinctes d'une colonne brute, renvoie (valeurs, masque NULL, masque d'échec)
+    codes, uniques = pd.factorize(np.array(raw, dtype=object))
+    converted = [None] * len(uniques)
+    failed = np.zeros(len(uniques), dtype=bool)
+    for i, value in enumerate(uniques):
+        try:
+            converted[i] = convert(value)
+        except ValueError:
+            failed[i] = True
+    null = np.array([v is None for v in converted], dtype=bool)
+    if dtype is object:
+        vals = np.empty(len(uniques), dtype=object)
+        vals[:] = converted
+    else:
+        if dtype is np.int64:
+            for i, v in enumerate(converted):
+                if v is not None and not _INT64_MIN <= v <= _INT64_MAX:
+                    failed[i] = True
+                    converted[i] = None
+        vals = np.array([0 if v is None else v for v in converted], dtype=dtype)
+    return vals[codes], null[codes], failed[codes]
+
+
+def _valid_imo_mask(imo):
+    # version en colonnes de utils.valid_imo: 7 chiffres et chiffre de contrôle
+    valid = (imo >= 1000000) & (imo <= 9999999)
+    digits = [(imo // 10 ** (6 - k)) % 10 for k in range(7)]
+    checksum = sum((7 - k) * digits[k] for k in range(6))
+    return valid & (digits[6] == checksum % 10)
+
+
+def readcsv(fp):
+    _set_field_size_limit()
 
     # Les lignes correspondent aux en-têtes de colonnes.
     # Utilisées pour extraire les index des colonnes que nous extrayons
-    cols = fp.readline().rstrip('').split(';')
-    indices = {}
-    n_cols = len(cols)
-    try:
-        for col in AIS_CSV_COLUMNS:
-            indices[col] = cols.index(col)
-    except Exception as e:
-        raise RuntimeError("Missing Columns in File Header: {}".format(e))
+    indices, n_cols = _header_indices(fp.readline())
 
     try:
         for row in csv.reader(fp, delimiter=';', quotechar='"'):
@@ -381,6 +930,34 @@ def readcsv(fp):
         raise RuntimeError(e)
 
 
+def _set_field_size_limit():
+    # correctif pour une erreur de grand champ. Spécifiez la taille maximale du champ à la valeur int convertible maximale.
+    # source: http://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
+    max_int = sys.maxsize
+    decrement = True
+    while decrement:
+        # diminuer la valeur max_int d'un facteur 10
+        # tant que l'OverflowError se produit.
+        decrement = False
+        try:
+            csv.field_size_limit(max_int)
+        except OverflowError:
+            max_int = int(max_int / 10)
+            decrement = True
+
+
+def _header_indices(header):
+    # renvoie l'index de chaque colonne extraite et le nombre de colonnes de l'en-tête
+    cols = header.rstrip('').split(';')
+    indices = {}
+    try:
+        for col in AIS_CSV_COLUMNS:
+            indices[col] = cols.index(col)
+    except Exception as e:
+        raise RuntimeError("Missing Columns in File Header: {}".format(e))
+    return indices, len(cols)
+
+
 def readxml(fp):
     current = _empty_row()
     # itérer les événements XML 'end'
@@ -1,54 +1,128 @@
 
 import logging
 import time
+from ais_parser.repositories import sql
 
 EXPORT_COMMANDS = [('run', 'create or update the imo list table.')]
+EXPORT_ARGUMENTS = {'run': [('--incremental', {'action': 'store_true',
+                                               'help': 'Only Aggregate Messages Added Since the Last Run.'})]}
 INPUTS = []
 OUTPUTS = ["aisdb"]
 
-def run(_, out):
-    create_imolist(out['aisdb'])
+# table temporaire des paires mmsi, imo_number agrégées, supprimée à la fin de la transaction
+STAGING_TABLE = 'imo_list_staging'
 
-def create_imolist(aisdb):
+def run(_, out, incremental=False):
+    create_imolist(out['aisdb'], incremental=incremental)
 
-    with aisdb.conn.cursor() as cur:
-        start = time.time()
+def create_imolist(aisdb, incremental=False):
+    """Agrège les paires mmsi, imo_number de ais_clean et ais_dirty dans imo_list.
+
+    En mode incrémental, seuls les messages dont l'identifiant dépasse le dernier identifiant agrégé
+    (table imo_list_watermark) sont lus; ce dernier identifiant est enregistré à chaque exécution, dans la même
+    transaction que la fusion. A lancer hors d'une analyse en cours, dont les messages non validés seraient ignorés.
+    """
 
-        # collecter un ensemble existant de tuples mmsi, imo_number dans imo_list
-        cur.execute("SELECT mmsi, imo_number FROM {}".format(aisdb.imolist.get_name()))
-        existing_tuples = set(cur.fetchall())
-        logging.info("Existing mmsi, imo_number Pairs = %d (%fs)", len(existing_tuples), time.time()-start)
+    with aisdb.conn.cursor() as cur:
+        _create_staging(cur)
 
-        # requête pour mmsi, imo_number, tuples d'intervalle à partir de la base de données propre, puis les insérer dans la table imo_list.
+        # requête pour mmsi, imo_number, tuples d'intervalle à partir de la base de données propre, chargés dans la table temporaire.
         logging.info("Getting mmsi, imo_number Pairs from Clean DB")
-        start = time.time()
-        cur.execute("SELECT mmsi, imo_number, MIN(complete_sys_date), MAX(complete_sys_date) FROM {} GROUP BY mmsi, imo_number".format(aisdb.clean.get_name()))
-        logging.info("Got New mmsi, imo_number Pairs List (%fs)", time.time()-start)
-        _upsert_imo_tuples(aisdb, cur, existing_tuples)
+        _stage_imo_tuples(aisdb, cur, aisdb.clean.get_name(), None, incremental)
 
-        # requête pour mmsi, imo_number, tuples d'intervalle à partir de la base de données sale, puis les insérer dans la table imo_list.
+        # requête pour mmsi, imo_number, tuples d'intervalle à partir de la base de données sale, chargés dans la table temporaire.
         logging.info("Getting mmsi, imo_number Pairs from Dirty DB")
-        start = time.time()
-        cur.execute("SELECT mmsi, imo_number, MIN(complete_sys_date), MAX(complete_sys_date) FROM {} WHERE message_type = 5 GROUP BY mmsi, imo_number".format(aisdb.dirty.get_name()))
-        logging.info("Got New mmsi, imo_number Pairs List (%fs)", time.time()-start)
-        _upsert_imo_tuples(aisdb, cur, existing_tuples)
+        _stage_imo_tuples(aisdb, cur, aisdb.dirty.get_name(), "message_type = 5", incremental)
+
+        _merge_imo_tuples(aisdb, cur)
 
         aisdb.conn.commit()
 
-def _upsert_imo_tuples(aisdb, result_cursor, existing_tuples):
-
-    with aisdb.conn.cursor() as insert_cur:
-        start = time.time()
-        insert_ctr = 0
-        update_ctr = 0
-        for mmsi, imo_number, min_time, max_time in result_cursor:
-            if (mmsi, imo_number) in existing_tuples:
-                insert_cur.execute("""UPDATE {} SET
-                    first_seen = LEAST(first_seen, %s),
-                    last_seen = GREATEST(last_seen, %s)
-                    WHERE mmsi = %s AND imo_number = %s""".format(aisdb.imolist.get_name()), [min_time, max_time, mmsi, imo_number])
-                update_ctr = update_ctr + insert_cur.rowcount
-            else:
-                insert_cur.execute("INSERT INTO {} (mmsi, imo_number, first_seen, last_seen) VALUES (%s,%s,%s,%s)".format(aisdb.imolist.get_name()), [mmsi, imo_number, min_time, max_time])
-                insert_ctr = insert_ctr + 1
-        logging.info("Inserted %d New Rows, Updated %d Rows (%f)", insert_ctr, update_ctr, time.time()-start)
+def merge_imo_pairs(aisdb, pairs):
+    """Fusionne dans imo_list des paires calculées ailleurs (par exemple pendant l'analyse), dans la transaction
+    courante.
+
+    Arguments
+    ---------
+    paires: dict
+        (mmsi, imo_number) -> (first_seen, last_seen)
+    """
+    if len(pairs) == 0:
+        return
+    with aisdb.conn.cursor() as cur:
+        _create_staging(cur)
+        staging = sql.Table(aisdb, STAGING_TABLE, aisdb.imolist_db_spec['cols'])
+        staging.insert_rowsbatch([{'mmsi': mmsi, 'imo_number': imo_number, 'first_seen': first_seen,
+                                   'last_seen': last_seen}
+                                  for (mmsi, imo_number), (first_seen, last_seen) in pairs.items()])
+        _merge_imo_tuples(aisdb, cur)
+        cur.execute("TRUNCATE {}".format(STAGING_TABLE))
+
+def _create_staging(cur):
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS {} (mmsi integer, imo_number integer, "
+                "first_seen timestamp without time zone, last_seen timestamp without time zone) "
+                "ON COMMIT DROP".format(STAGING_TABLE))
+
+def _stage_imo_tuples(aisdb, cur, table, condition, incremental):
+    # l'agrégation reste côté serveur: ses résultats sont insérés directement dans la table temporaire
+    start = time.time()
+    watermark = aisdb.imolist_watermark.get_name()
+    cur.execute("SELECT max(id) FROM {}".format(table))
+    max_id = cur.fetchone()[0]
+    last_id = None
+    if incremental:
+        cur.execute("SELECT last_id FROM {} WHERE table_name = %s".format(watermark), [table])
+        row = cur.fetchone()
+        if row is None:
+            logging.info("No Previous Run for %s, Aggregating All Messages", table)
+        else:
+            last_id = row[0]
+    conditions = []
+    params = []
+    if condition is not None:
+        conditions.append(condition)
+    if last_id is not None:
+        conditions.append("id > %s")
+        params.append(last_id)
+    if max_id is not None:
+        conditions.append("id <= %s")
+        params.append(max_id)
+    where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+    cur.execute("INSERT INTO {} (mmsi, imo_number, first_seen, last_seen) "
+                "SELECT mmsi, imo_number, MIN(complete_sys_date), MAX(complete_sys_date) FROM {}{} "
+                "GROUP BY mmsi, imo_number".format(STAGING_TABLE, table, where), params)
+    logging.info("Got %d New mmsi, imo_number Pairs (%fs)", cur.rowcount, time.time()-start)
+    if max_id is not None:
+        cur.execute("""INSERT INTO {} (table_name, last_id, timestamp) VALUES (%s, %s, now())
+            ON CONFLICT (table_name) DO UPDATE SET last_id = EXCLUDED.last_id, timestamp = EXCLUDED.timestamp"""
+                    .format(watermark), [table, max_id])
+
+def _merge_imo_tuples(aisdb, cur):
+    """Fusionne les paires de la table temporaire dans imo_list en quelques requêtes ensemblistes.
+
+    Une paire présente dans les deux bases n'est fusionnée qu'une fois (GROUP BY). imo_number NULL n'est jamais
+    en conflit avec la contrainte UNIQUE (mmsi, imo_number): ces paires sont mises à jour ou insérées à part.
+    """
+    imolist = aisdb.imolist.get_name()
+    start = time.time()
+    cur.execute("""INSERT INTO {0} (mmsi, imo_number, first_seen, last_seen)
+        SELECT mmsi, imo_number, MIN(first_seen), MAX(last_seen) FROM {1}
+        WHERE imo_number IS NOT NULL GROUP BY mmsi, imo_number
+        ON CONFLICT (mmsi, imo_number) DO UPDATE SET
+        first_seen = LEAST({0}.first_seen, EXCLUDED.first_seen),
+        last_seen = GREATEST({0}.last_seen, EXCLUDED.last_seen)""".format(imolist, STAGING_TABLE))
+    merge_ctr = cur.rowcount
+    cur.execute("""UPDATE {0} SET
+        first_seen = LEAST({0}.first_seen, s.first_seen),
+        last_seen = GREATEST({0}.last_seen, s.last_seen)
+        FROM (SELECT mmsi, MIN(first_seen) AS first_seen, MAX(last_seen) AS last_seen FROM {1}
+              WHERE imo_number IS NULL GROUP BY mmsi) AS s
+        WHERE {0}.mmsi = s.mmsi AND {0}.imo_number IS NULL""".format(imolist, STAGING_TABLE))
+    merge_ctr = merge_ctr + cur.rowcount
+    cur.execute("""INSERT INTO {0} (mmsi, imo_number, first_seen, last_seen)
+        SELECT mmsi, NULL, MIN(first_seen), MAX(last_seen) FROM {1} s
+        WHERE imo_number IS NULL
+        AND NOT EXISTS (SELECT 1 FROM {0} WHERE {0}.mmsi = s.mmsi AND {0}.imo_number IS NULL)
+        GROUP BY mmsi""".format(imolist, STAGING_TABLE))
+    merge_ctr = merge_ctr + cur.rowcount
+    logging.info("Merged %d mmsi, imo_number Pairs Into %s (%fs)", merge_ctr, imolist, time.time()-start)
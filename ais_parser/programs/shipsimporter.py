@@ -1,94 +1,175 @@
 
+import collections
 import logging
+import multiprocessing.util
 import time
 import threading
 import psycopg2
+import psycopg2.extras
 import queue
-from ais_parser.utils import interpolatepassages, valid_imo, detect_locationoutliers
+from ais_parser import messages
+from ais_parser.utils import interpolatepassages, valid_imo, iter_locationoutliers, process_context, \
+    DISTANCE_BACKENDS
 
 EXPORT_COMMANDS = [('run', 'Extract a Subset of Clean Ships into ais_extended Tables')]
 INPUTS = []
 OUTPUTS = ['aisdb']
+# Arguments optionnels des commandes, ajoutés à la ligne de commande
+EXPORT_ARGUMENTS = {'run': [('--workers', {'dest': 'n_threads', 'type': int,
+                                           'help': 'Number of Workers Importing Vessels (Default 2).'}),
+                            ('--mode', {'choices': ['threads', 'processes'],
+                                        'help': 'Run Workers as Threads (Default) or Processes.'}),
+                            ('--distance', {'choices': sorted(DISTANCE_BACKENDS),
+                                            'help': 'Distance Used by the Outlier Detection (Default geodesic).'}),
+                            ('--batch-size', {'type': int,
+                                              'help': 'Messages Read and Inserted per Batch (Default 10000).'})]}
 
+# nombre de messages d'un intervalle lus, filtrés et insérés à la fois
+BATCH_SIZE = 10000
 
-def run(inp, out, n_threads=2, dropindices=False):
+
+def run(inp, out, n_threads=2, dropindices=False, mode='threads', distance='geodesic', batch_size=BATCH_SIZE):
     aisdb = out['aisdb']
     valid_imos, imo_mmsi_intervals = good_ships_filter(aisdb)
     logging.info("Got %d Valid IMO Numbers, Using %d MMSI Numbers", len(valid_imos), len(imo_mmsi_intervals))
 
-    # intervalles de pré-filtrage
-    def filter_intervals(interval):
-        remain = get_remaininginterval(aisdb, *interval)
-        if not remain is None:
-            return [interval[0], interval[1], remain[0], remain[1]]
-        else:
-            return None
-
-    filtered_intervals = map(filter_intervals, imo_mmsi_intervals)
+    # intervalles de pré-filtrage, en une seule requête
+    remaining = get_remainingintervals(aisdb, imo_mmsi_intervals)
+    filtered_intervals = [[interval[0], interval[1], remain[0], remain[1]]
+                          for interval, remain in zip(imo_mmsi_intervals, remaining) if not remain is None]
     # les intervalles de tri par MMSI améliorent les performances sur une table en cluster
-    sorted_intervals = sorted(filter(None, filtered_intervals), key=lambda x: x[0])
+    sorted_intervals = sorted(filtered_intervals, key=lambda x: x[0])
+    # un couple (mmsi, imo_number) présent plusieurs fois doit être recalculé après chaque importation
+    prefiltered = len(set((x[0], x[1]) for x in sorted_intervals)) == len(sorted_intervals)
     logging.info("%d Intervals to Import", len(sorted_intervals))
     # insérer les navires dans la table étendue.
     if len(sorted_intervals) > 0:
         if dropindices:
             aisdb.extended.drop_indices()
-        generate_extendedtable(aisdb, sorted_intervals, n_threads=n_threads)
+        generate_extendedtable(aisdb, sorted_intervals, n_threads=n_threads, prefiltered=prefiltered, mode=mode,
+                               distance=distance, batch_size=batch_size)
         if dropindices:
-            aisdb.extended.create_indices()
+            errors = aisdb.build_indices([aisdb.extended])
+            if len(errors) > 0:
+                logging.error("Indices Not Built: %s", ", ".join(errors))
     logging.info("Vessel Importer Done.")
 
 
 def good_ships_filter(aisdb):
+    """Sélectionne les numéros IMO valides et leurs intervalles (mmsi, imo_number, début, fin).
+
+    La table imo_list est lue en une seule requête, puis pour chaque IMO valide on reproduit
+    en mémoire la jointure avec les lignes sans IMO du même mmsi (OVERLAPS, LEAST, GREATEST
+    avec la sémantique de PostgreSQL) et la vérification de la réutilisation des mmsi."""
 
     with aisdb.conn.cursor() as cur:
-        cur.execute("SELECT distinct imo_number from {}".format(aisdb.imolist.get_name()))
-        imo_list = [row[0] for row in cur.fetchall() if valid_imo(row[0])]
-        logging.info("Checking %d IMOs", len(imo_list))
-
-        valid_imos = []
-        imo_mmsi_intervals = []
-
-        for imo_number in imo_list:
-            cur.execute("""select a.mmsi, a.imo_number, (a.first_seen, a.last_seen) overlaps (b.first_seen, b.last_seen), LEAST(a.first_seen, b.first_seen), GREATEST(a.last_seen, b.last_seen)
-                    from imo_list as a
-                    join imo_list as b on a.mmsi = b.mmsi and b.imo_number is null
-                    where a.imo_number = %s
-                    ORDER BY LEAST(a.first_seen, b.first_seen) ASC""", [imo_number])
-            mmsi_ranges = cur.fetchall()
-            if len(mmsi_ranges) == 0:
-                # logging.info("No MMSI numbers for IMO_Number %s", imo_number)
-                continue
-
-            valid = True
-            last_end = None
-            for mmsi, _, overlap, start, end in mmsi_ranges:
-                if not overlap:
-                    valid = False
-                    # logging.info("(%s, %s) does not overlap (%s, _)", mmsi, imo_number, mmsi)
-                    break
-                if last_end != None and start < last_end:
-                    valid = False
-                    # logging.info("IMO: %s, overlapping MMSI intervals", imo_number)
-                    break
-                last_end = end
-
-            if valid:
-                # vérifier les autres utilisateurs de ce numéro mmsi
-                mmsi_list = [row[0] for row in mmsi_ranges]
-                cur.execute("""select a.mmsi, a.imo_number, b.imo_number
-                    from imo_list as a
-                    join imo_list as b on a.mmsi = b.mmsi and a.imo_number < b.imo_number
-                    where a.mmsi IN ({})""".format(','.join(['%s' for i in mmsi_list])), mmsi_list)
-                if cur.rowcount == 0:
-                    # c'est valable!
-                    valid_imos.append(imo_number)
-                    for mmsi, _, _, start, end in mmsi_ranges:
-                        imo_mmsi_intervals.append([mmsi, imo_number, start, end])
-                else:
-                    pass
-                    # logging.info("IMO_Number: %s, reuse of MMSI", imo_number)
+        start = time.time()
+        cur.execute("SELECT mmsi, imo_number, first_seen, last_seen FROM {}".format(aisdb.imolist.get_name()))
+        imo_rows = collections.defaultdict(list)
+        null_rows = collections.defaultdict(list)
+        mmsi_imos = collections.defaultdict(set)
+        for mmsi, imo_number, first_seen, last_seen in cur:
+            if imo_number is None:
+                null_rows[mmsi].append((first_seen, last_seen))
+            else:
+                imo_rows[imo_number].append((mmsi, first_seen, last_seen))
+                mmsi_imos[mmsi].add(imo_number)
+        logging.info("Got %d imo_list Rows (%fs)", cur.rowcount, time.time() - start)
+
+    imo_list = [imo_number for imo_number in sorted(imo_rows) if valid_imo(imo_number)]
+    logging.info("Checking %d IMOs", len(imo_list))
+
+    valid_imos = []
+    imo_mmsi_intervals = []
+
+    for imo_number in imo_list:
+        # jointure avec les lignes sans IMO du même mmsi
+        mmsi_ranges = []
+        for mmsi, a_first, a_last in imo_rows[imo_number]:
+            for b_first, b_last in null_rows.get(mmsi, []):
+                mmsi_ranges.append((mmsi, imo_number, _overlaps(a_first, a_last, b_first, b_last),
+                                    _least(a_first, b_first), _greatest(a_last, b_last)))
+        if len(mmsi_ranges) == 0:
+            continue
+        # ORDER BY LEAST(a.first_seen, b.first_seen) ASC, les valeurs NULL en dernier
+        mmsi_ranges.sort(key=lambda row: (row[3] is None, row[3] or 0))
+
+        valid = True
+        last_end = None
+        for mmsi, _, overlap, start, end in mmsi_ranges:
+            if not overlap:
+                valid = False
+                break
+            if last_end != None and start < last_end:
+                valid = False
+                break
+            last_end = end
+
+        if valid:
+            # vérifier les autres utilisateurs de ce numéro mmsi
+            if all(len(mmsi_imos[row[0]]) <= 1 for row in mmsi_ranges):
+                # c'est valable!
+                valid_imos.append(imo_number)
+                for mmsi, _, _, start, end in mmsi_ranges:
+                    imo_mmsi_intervals.append([mmsi, imo_number, start, end])
+
+    return valid_imos, imo_mmsi_intervals
+
+
+def _least(a, b):
+    # LEAST de PostgreSQL: les valeurs NULL sont ignorées
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _greatest(a, b):
+    # GREATEST de PostgreSQL: les valeurs NULL sont ignorées
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def _overlaps(start1, end1, start2, end2):
+    """(start1, end1) OVERLAPS (start2, end2) de PostgreSQL, None pour un résultat NULL."""
+    # une borne NULL est remplacée par l'autre, les bornes sont ordonnées
+    if start1 is None:
+        if end1 is None:
+            return None
+        start1, end1 = end1, None
+    elif end1 is not None and start1 > end1:
+        start1, end1 = end1, start1
+    if start2 is None:
+        if end2 is None:
+            return None
+        start2, end2 = end2, None
+    elif end2 is not None and start2 > end2:
+        start2, end2 = end2, start2
 
-        return valid_imos, imo_mmsi_intervals
+    if start1 > start2:
+        if end2 is None:
+            return None
+        if start1 < end2:
+            return True
+        if end1 is None:
+            return None
+        return False
+    elif start1 < start2:
+        if end1 is None:
+            return None
+        if start2 < end1:
+            return True
+        if end2 is None:
+            return None
+        return False
+    else:
+        if end1 is None or end2 is None:
+            return None
+        return True
 
 
 def cluster_table(aisdb, table):
@@ -100,17 +181,24 @@ def cluster_table(aisdb, table):
         cur.execute("CLUSTER {} USING {}".format(table.name, index_name))
 
 
-def generate_extendedtable(aisdb, intervals, n_threads=2):
+def generate_extendedtable(aisdb, intervals, n_threads=2, prefiltered=False, mode='threads', distance='geodesic',
+                           batch_size=BATCH_SIZE):
+    """Importe les intervalles dans la table étendue avec n_threads threads ou, en mode 'processes',
+    un pool de n_threads processus ayant chacun leur connexion à la base de données."""
     logging.info("Inserting %d Squeaky Clean MMSIs", len(intervals))
 
+    if mode == 'processes':
+        return _generate_extendedtable_processes(aisdb, intervals, n_threads, prefiltered, distance, batch_size)
+
     start = time.time()
 
     interval_q = queue.Queue()
     for interval in sorted(intervals, key=lambda x: x[0]):
         interval_q.put(interval)
 
-    pool = [threading.Thread(target=interval_copy, daemon=True, args=(aisdb.options, interval_q)) for i in
-            range(n_threads)]
+    pool = [threading.Thread(target=interval_copy, daemon=True,
+                             args=(aisdb.options, interval_q, prefiltered, distance, batch_size))
+            for i in range(n_threads)]
     [t.start() for t in pool]
 
     total = len(intervals)
@@ -126,93 +214,163 @@ def generate_extendedtable(aisdb, intervals, n_threads=2):
     interval_q.join()
 
 
-def interval_copy(db_options, interval_q):
+def interval_copy(db_options, interval_q, prefiltered=False, distance='geodesic', batch_size=BATCH_SIZE):
     from ais_parser.repositories import aisdb as db
     aisdb = db.load(db_options)
     logging.debug("Start Interval Copier Task")
     with aisdb:
         while not interval_q.empty():
             interval = interval_q.get()
-            process_intervalseries(aisdb, interval)
-            interval_q.task_done()
+            try:
+                process_intervalseries(aisdb, interval, prefiltered=prefiltered, distance=distance,
+                                       batch_size=batch_size)
+            except Exception as e:
+                logging.warning("Error Importing Interval %s: %s", interval, repr(e))
+                aisdb.conn.rollback()
+            finally:
+                interval_q.task_done()
+
+
+# connexion à la base de données d'un processus du pool
+_worker_db = None
+
+
+def _init_worker(db_options):
+    global _worker_db
+    from ais_parser.repositories import aisdb as db
+    _worker_db = db.load(db_options)
+    _worker_db.__enter__()
+    # la connexion est fermée à la sortie normale du processus (Pool.close puis Pool.join)
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+    logging.debug("Start Interval Copier Process")
+
 
+def _close_worker():
+    global _worker_db
+    if _worker_db is not None:
+        _worker_db.__exit__(None, None, None)
+        _worker_db = None
 
-def process_intervalseries(aisdb, interval):
+
+def _process_interval(task):
+    interval, prefiltered, distance, batch_size = task
+    try:
+        return interval, process_intervalseries(_worker_db, interval, prefiltered=prefiltered, distance=distance,
+                                                batch_size=batch_size), None
+    except Exception as e:
+        _worker_db.conn.rollback()
+        return interval, 0, repr(e)
+
+
+def _generate_extendedtable_processes(aisdb, intervals, n_processes, prefiltered, distance, batch_size):
+    total = len(intervals)
+    completed = 0
+    rows = 0
+    errors = 0
+    start = time.time()
+    last_report = start
+    tasks = [(interval, prefiltered, distance, batch_size) for interval in sorted(intervals, key=lambda x: x[0])]
+    # le chargeur importe ce programme sous le nom 'shipsimporter': les processus du pool retrouvent
+    # les fonctions par le nom complet du module
+    from ais_parser.programs import shipsimporter
+    # les options sont copiées dans un dict pour être transmises aux processus
+    with process_context().Pool(n_processes, initializer=shipsimporter._init_worker,
+                                initargs=(dict(aisdb.options),)) as pool:
+        for interval, count, error in pool.imap_unordered(shipsimporter._process_interval, tasks):
+            completed = completed + 1
+            rows = rows + count
+            if error is not None:
+                errors = errors + 1
+                logging.warning("Error Importing Interval %s: %s", interval, error)
+            if time.time() - last_report >= 5:
+                logging.info("%d/%d MMSIs Completed, %f/s.", completed, total, completed / (time.time() - start))
+                last_report = time.time()
+        # arrêt normal des processus, qui ferment leur connexion (la sortie du bloc with les terminerait)
+        pool.close()
+        pool.join()
+    logging.info("Imported %d Rows for %d/%d MMSIs With %d Processes, %d Errors (%fs)", rows, completed - errors,
+                 total, n_processes, errors, time.time() - start)
+
+
+def process_intervalseries(aisdb, interval, prefiltered=False, distance='geodesic', batch_size=BATCH_SIZE):
     mmsi, imo_number, start, end = interval
     t_start = time.time()
-    # intervalle de contrainte basé sur l'importation précédente
-    remaining_work = get_remaininginterval(aisdb, mmsi, imo_number, start, end)
-    if remaining_work is None:
-        # logging.info("Interval was already inserted: (%s, %s, %s, %s)", mmsi, imo, start, end)
-        return 0
-    else:
-        start, end = remaining_work
+    # intervalle de contrainte basé sur l'importation précédente, sauf s'il a déjà été calculé
+    if not prefiltered:
+        remaining_work = get_remaininginterval(aisdb, mmsi, imo_number, start, end)
+        if remaining_work is None:
+            # logging.info("Interval was already inserted: (%s, %s, %s, %s)", mmsi, imo, start, end)
+            return 0
+        else:
+            start, end = remaining_work
 
-    # obtenir des données pour cette plage d'intervalles
-    msg_stream = aisdb.get_message_stream(mmsi, from_ts=start, to_ts=end, use_clean_db=True)
-    row_count = len(msg_stream)
+    # obtenir des données pour cette plage d'intervalles, lues par lots avec un curseur côté serveur,
+    # en colonnes si NumPy est disponible
+    msg_batches = aisdb.iter_message_stream(mmsi, from_ts=start, to_ts=end, use_clean_db=True,
+                                            batch_size=batch_size, as_batch=messages.np is not None)
+    row_count = insert_messagestream(aisdb, [mmsi, imo_number, start, end], msg_batches, distance=distance)
     if row_count == 0:
         logging.warning("No Rows to Insert for Interval %s", interval)
         return 0
 
-    insert_messagestream(aisdb, [mmsi, imo_number, start, end], msg_stream)
-
     # terminé, validation
     aisdb.conn.commit()
     logging.debug("Inserted %d Rows for MMSI %d. (%fs)", row_count, mmsi, time.time() - t_start)
     return row_count
 
 
-def insert_messagestream(aisdb, interval, msg_stream):
+def insert_messagestream(aisdb, interval, msg_batches, distance='geodesic'):
+    """Filtre et insère dans la table étendue un flux de messages lu par lots (listes de dicts ou MessageBatch).
+
+    Renvoie le nombre de messages lus; rien n'est enregistré pour un flux vide."""
 
     mmsi, imo_number, start, end = interval
 
-    valid = []
-    invalid = []
+    row_count = 0
+    valid_count = 0
+    invalid_count = 0
+    artificial_count = 0
 
     # appeler le filtre de messages
-    k = 0
-    i = 0
-    j = 0
-
-    for val in detect_locationoutliers(msg_stream):
-
-        if val is False:
-
-            valid.insert(i, msg_stream[k])
-            i = i+1
-            k = k+1
-
+    for batch, outliers in iter_locationoutliers(msg_batches, distance=distance):
+        if isinstance(batch, messages.MessageBatch):
+            valid = batch[~outliers]
         else:
+            valid = [message for message, outlier in zip(batch, outliers) if not outlier]
+        row_count = row_count + len(batch)
+        valid_count = valid_count + len(valid)
+        invalid_count = invalid_count + len(batch) - len(valid)
 
-            invalid.insert(j, msg_stream[k])
-            j = j + 1
-            k = k+1
+        artificial = list(interpolatepassages(valid))
+        artificial_count = artificial_count + len(artificial)
 
-    artificial = interpolatepassages(valid)
+        aisdb.extended.insert_rowsbatch(valid)
+        aisdb.extended.insert_rowsbatch(artificial)
 
-    aisdb.extended.insert_rowsbatch(valid + list(artificial))
+    if row_count == 0:
+        return 0
 
     # marquez le travail que nous avons accompli
     aisdb.action_log.insert_row({'action': "import",
                                  'mmsi': mmsi,
                                  'ts_from': start,
                                  'ts_to': end,
-                                 'count': len(valid)})
+                                 'count': valid_count})
 
     aisdb.action_log.insert_row({'action': "outlier detection (noop)",
                                  'mmsi': mmsi,
                                  'ts_from': start,
                                  'ts_to': end,
-                                 'count': len(invalid)})
+                                 'count': invalid_count})
 
     aisdb.action_log.insert_row({'action': "interpolation (noop)",
                                  'mmsi': mmsi,
                                  'ts_from': start,
                                  'ts_to': end,
-                                 'count': len(artificial)})
+                                 'count': artificial_count})
 
     upsert_intervaltoimolist(aisdb, mmsi, imo_number, start, end)
+    return row_count
 
 
 def get_remaininginterval(aisdb, mmsi, imo_number, start, end):
@@ -236,6 +394,47 @@ def get_remaininginterval(aisdb, mmsi, imo_number, start, end):
             return None
 
 
+def get_remainingintervals(aisdb, intervals, page_size=10000):
+    """Variante groupée de get_remaininginterval pour une liste d'intervalles (mmsi, imo_number, début, fin).
+
+    Les intervalles sont joints à imo_list_clean par une liste VALUES, page_size intervalles par requête.
+    Renvoie, dans l'ordre, l'intervalle restant (début, fin) ou None."""
+    remaining = [None] * len(intervals)
+    values = []
+    for idx, (mmsi, imo_number, start, end) in enumerate(intervals):
+        if start is not None and end is not None and start > end:
+            # tsrange(début, fin) n'existe pas
+            logging.warning("Error Calculating timetamp Intersection for MMSI %d: Range Lower Bound "
+                            "Greater Than Upper Bound", mmsi)
+            continue
+        values.append((idx, mmsi, imo_number, start, end))
+
+    # la différence de tsrange échoue si le résultat n'est pas contigu: elle est remplacée par NULL
+    sql = """SELECT idx, matched, CASE WHEN NOT isempty(i) AND NOT (r &> i) AND NOT (r &< i) THEN NULL ELSE r - i END
+        FROM (SELECT v.idx, c.mmsi IS NOT NULL AS matched, tsrange(v.ts_from, v.ts_to) AS r,
+                CASE WHEN c.first_seen - interval '1 second' > c.last_seen + interval '1 second' THEN NULL
+                ELSE tsrange(v.ts_from, v.ts_to) * tsrange(c.first_seen - interval '1 second', c.last_seen + interval '1 second')
+                END AS i
+            FROM (VALUES %s) AS v(idx, mmsi, imo_number, ts_from, ts_to)
+            LEFT JOIN {} AS c ON c.mmsi = v.mmsi AND c.imo_number = v.imo_number) AS q""".format(aisdb.clean_imolist.name)
+
+    t_start = time.time()
+    with aisdb.conn.cursor() as cur:
+        rows = psycopg2.extras.execute_values(cur, sql, values, template="(%s, %s, %s, %s::timestamp, %s::timestamp)",
+                                              page_size=page_size, fetch=True)
+    for idx, matched, sub_interval in rows:
+        mmsi, imo_number, start_ts, end_ts = intervals[idx]
+        if not matched:
+            remaining[idx] = (start_ts, end_ts)
+        elif sub_interval is None:
+            logging.warning("Error Calculating timetamp Intersection for MMSI %d: Range Difference Not Contiguous",
+                            mmsi)
+        elif not sub_interval.isempty:
+            remaining[idx] = (sub_interval.lower, sub_interval.upper)
+    logging.info("Computed %d Remaining Intervals (%fs)", len(values), time.time() - t_start)
+    return remaining
+
+
 def upsert_intervaltoimolist(aisdb, mmsi, imo_number, start, end):
     with aisdb.conn.cursor() as cur:
         cur.execute("SELECT COUNT(*) FROM {} WHERE mmsi = %s AND imo_number = %s"
@@ -1,6 +1,10 @@
 from ais_parser.repositories import sql
+from ais_parser.messages import MessageBatch
+import datetime
+import io
 import psycopg2
 import logging
+import time
 
 try:
     import pandas as pd
@@ -8,10 +12,28 @@ except ImportError:
     logging.warn("No pandas found")
     pd = None
 
+# nombre de lignes transférées par aller-retour par les curseurs nommés
+ITERSIZE = 10000
+
+# types de colonnes lus en entiers (Int64) dans les DataFrames
+DATAFRAME_INTEGER_TYPES = ('smallint', 'integer', 'bigint', 'serial', 'bigserial')
+
 EXPORT_COMMANDS = [('status', 'Report Status of This Repository.'),
                    ('create', 'Create The Repository.'),
                    ('truncate', 'Delete All Data in This Repository.'),
-                   ('update', 'Update The Database Schema')]
+                   ('update', 'Update The Database Schema'),
+                   ('reindex', 'Rebuild Indices With The Configured Index Profile.'),
+                   ('backfill_locations', 'Compute Missing Locations of ais_extended in Bulk.'),
+                   ('drop_partitions', 'Drop Message Partitions Ending Before a Date.')]
+EXPORT_ARGUMENTS = {'drop_partitions': [('before', {'help': 'Date (YYYY-MM-DD): Partitions of ais_clean and '
+                                                            'ais_dirty Ending at or Before It Are Dropped.'})]}
+
+# calcul de la colonne location de ais_extended accepté par l'option 'location_mode' du référentiel
+LOCATION_MODES = ('trigger', 'insert', 'generated')
+# expression SQL de la localisation SIG d'un message
+LOCATION_SQL = "ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography"
+# nombre d'identifiants traités par transaction lors du calcul des localisations manquantes
+BACKFILL_BATCH = 1000000
 
 
 def load(options, readonly=False):
@@ -89,6 +111,24 @@ class AISdb(sql.PgsqlRepository):
         ]
     }
 
+    # profils d'index de ais_clean, ais_dirty et ais_extended, choisis par l'option 'index_profile'
+    index_profiles = {
+        'default': clean_db_spec['indices'],
+        # BRIN sur la date (données ajoutées dans l'ordre chronologique), index composite des requêtes de
+        # get_message_stream (mmsi, tri par date) et index partiel des messages statiques lus par imolister
+        'compact': [
+            ('dt_brin_idx', ['Complete_Sys_Date'], 'brin'),
+            ('mmsi_dt_idx', ['MMSI', 'Complete_Sys_Date']),
+            ('imo_idx', ['IMO_Number']),
+            ('static_idx', ['MMSI', 'IMO_Number'], 'btree', 'message_type = 5')
+        ]
+    }
+    # compact, et un index GiST des positions pour les requêtes par zone:
+    # point(longitude, latitude) <@ box(point(lon1, lat1), point(lon2, lat2))
+    index_profiles['spatial'] = index_profiles['compact'] + [
+        ('lonlat_gist_idx', ['point(longitude, latitude)'], 'gist')
+    ]
+
     sources_db_spec = {
         'cols': [
             ('ID', 'SERIAL PRIMARY KEY'),
@@ -99,9 +139,28 @@ class AISdb(sql.PgsqlRepository):
             ('clean', 'integer'),
             ('dirty', 'integer'),
             ('source', 'integer')
+        ],
+        'indices': [
+            ('filename_source_idx', ['filename', 'source'])
         ]
     }
 
+    # point de reprise des fichiers en cours d'analyse, supprimé lorsque le fichier est terminé
+    checkpoints_db_spec = {
+        'cols': [
+            ('timestamp', 'timestamp without time zone DEFAULT now()'),
+            ('filename', 'TEXT'),
+            ('ext', 'TEXT'),
+            ('source', 'integer'),
+            ('line_offset', 'bigint'),
+            ('log_size', 'bigint'),
+            ('invalid', 'integer'),
+            ('clean', 'integer'),
+            ('dirty', 'integer')
+        ],
+        'constraint': ['CONSTRAINT ais_checkpoints_key UNIQUE (filename, source)']
+    }
+
     imolist_db_spec = {
         'cols': [
             ('mmsi', 'integer NOT NULL'),
@@ -112,6 +171,15 @@ class AISdb(sql.PgsqlRepository):
         'constraint': ['CONSTRAINT imo_list_key UNIQUE (mmsi, imo_number)']
     }
 
+    # dernier identifiant de ais_clean et ais_dirty agrégé dans imo_list, pour les mises à jour incrémentales
+    imolist_watermark_spec = {
+        'cols': [
+            ('table_name', 'TEXT PRIMARY KEY'),
+            ('last_id', 'bigint'),
+            ('timestamp', 'timestamp without time zone DEFAULT now()')
+        ]
+    }
+
     clean_imo_list = {
         'cols': imolist_db_spec['cols'],
         'constraint': ['CONSTRAINT imo_list_pkey PRIMARY KEY (mmsi, imo_number)']
@@ -136,13 +204,44 @@ class AISdb(sql.PgsqlRepository):
 
     def __init__(self, options, readonly=False):
         super(AISdb, self).__init__(options, readonly)
-        self.clean = sql.Table(self, 'ais_clean', self.clean_db_spec['cols'],
-                               self.clean_db_spec['indices'])
-        self.dirty = sql.Table(self, 'ais_dirty', self.dirty_db_spec['cols'],
-                               self.dirty_db_spec['indices'])
-        self.sources = sql.Table(self, 'ais_sources', self.sources_db_spec['cols'])
+        if 'partitioning' in options.keys():
+            self.partitioning = options['partitioning']
+        else:
+            self.partitioning = 'none'
+        if self.partitioning not in sql.PARTITION_INTERVALS:
+            logging.warning("Unknown partitioning " + self.partitioning + ", Using 'none' Instead.")
+            self.partitioning = 'none'
+        if 'index_profile' in options.keys():
+            self.index_profile = options['index_profile']
+        else:
+            self.index_profile = 'default'
+        if self.index_profile not in self.index_profiles:
+            logging.warning("Unknown index_profile " + self.index_profile + ", Using 'default' Instead.")
+            self.index_profile = 'default'
+        self.indices = self.index_profiles[self.index_profile]
+        if 'location_mode' in options.keys():
+            self.location_mode = options['location_mode']
+        else:
+            self.location_mode = 'trigger'
+        if self.location_mode not in LOCATION_MODES:
+            logging.warning("Unknown location_mode " + self.location_mode + ", Using 'trigger' Instead.")
+            self.location_mode = 'trigger'
+        if self.partitioning == 'none':
+            self.clean = sql.Table(self, 'ais_clean', self.clean_db_spec['cols'], self.indices)
+            self.dirty = sql.Table(self, 'ais_dirty', self.dirty_db_spec['cols'], self.indices)
+        else:
+            # tables partitionnées par Complete_Sys_Date, l'option doit être choisie avant (create)
+            self.clean = sql.PartitionedTable(self, 'ais_clean', self.clean_db_spec['cols'], self.indices,
+                                              interval=self.partitioning)
+            self.dirty = sql.PartitionedTable(self, 'ais_dirty', self.dirty_db_spec['cols'], self.indices,
+                                              interval=self.partitioning)
+        self.sources = sql.Table(self, 'ais_sources', self.sources_db_spec['cols'],
+                                 self.sources_db_spec['indices'])
+        self.checkpoints = sql.Table(self, 'ais_checkpoints', self.checkpoints_db_spec['cols'],
+                                     constraint=self.checkpoints_db_spec['constraint'])
         self.imolist = sql.Table(self, 'imo_list', self.imolist_db_spec['cols'],
                                  constraint=self.imolist_db_spec['constraint'])
+        self.imolist_watermark = sql.Table(self, 'imo_list_watermark', self.imolist_watermark_spec['cols'])
         if self.postgis == 'yes':
             self.extended = AISExtendedTable(self)
 
@@ -151,10 +250,11 @@ class AISdb(sql.PgsqlRepository):
         self.action_log = sql.Table(self, 'action_log', self.action_log_spec['cols'], self.action_log_spec['indices'],
                                     constraint=self.action_log_spec['constraint'])
         if self.postgis == 'yes':
-            self.tables = [self.clean, self.dirty, self.sources, self.imolist, self.extended, self.clean_imolist,
-                           self.action_log]
+            self.tables = [self.clean, self.dirty, self.sources, self.checkpoints, self.imolist,
+                           self.imolist_watermark, self.extended, self.clean_imolist, self.action_log]
         else:
-            self.tables = [self.clean, self.dirty, self.sources, self.imolist, self.clean_imolist, self.action_log]
+            self.tables = [self.clean, self.dirty, self.sources, self.checkpoints, self.imolist,
+                           self.imolist_watermark, self.clean_imolist, self.action_log]
 
     def status(self):
         print("Status of PGSql Database " + self.db + ":")
@@ -189,6 +289,81 @@ class AISdb(sql.PgsqlRepository):
                 except psycopg2.ProgrammingError as error:
                     logging.error("Error Updating Database Schema for Table {}".format(table_name))
                     logging.error(error.pgerror)
+        # tables et index ajoutés depuis la création du schéma
+        self.checkpoints.create()
+        self.imolist_watermark.create()
+        self.sources.create_indices()
+        if self.postgis == 'yes':
+            self.extended.set_location_mode()
+
+    def reindex(self):
+        """Reconstruit les index des tables de messages avec le profil choisi, après suppression des index
+        de tous les profils (pour changer de profil sur une base existante)"""
+        specs = {}
+        for profile in self.index_profiles.values():
+            for spec in profile:
+                specs[spec[0]] = spec
+        tables = [self.clean, self.dirty]
+        if self.postgis == 'yes':
+            tables.append(self.extended)
+        for table in tables:
+            indices = table.indices
+            table.indices = list(specs.values())
+            if isinstance(table, sql.PartitionedTable):
+                table.drop_indices(table.partition_names())
+            else:
+                table.drop_indices()
+            table.indices = indices
+        errors = self.build_indices(tables)
+        if len(errors) > 0:
+            logging.error("Indices Not Built: %s", ", ".join(errors))
+
+    def backfill_locations(self):
+        """Calcule en masse la localisation SIG des messages de ais_extended qui n'en ont pas"""
+        if self.postgis != 'yes':
+            logging.warning("PostGIS Disabled, No Locations to Compute")
+            return 0
+        return self.extended.backfill_locations()
+
+    def drop_partitions(self, before):
+        """Supprime les partitions de ais_clean et ais_dirty se terminant au plus tard à la date before
+        (datetime ou chaîne 'YYYY-MM-DD'), et renvoie leurs noms"""
+        if not isinstance(before, datetime.datetime):
+            before = datetime.datetime.strptime(before, '%Y-%m-%d')
+        if self.partitioning == 'none':
+            logging.warning("Message Tables Not Partitioned, No Partitions to Drop")
+            return []
+        dropped = []
+        for table in [self.clean, self.dirty]:
+            dropped.extend(table.drop_partitions(before))
+        logging.info("Dropped %d Partitions", len(dropped))
+        return dropped
+
+    def get_parsed_files(self, source):
+        """Renvoie l'ensemble des noms de fichiers déjà analysés pour cette source"""
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT DISTINCT filename FROM {} WHERE source = %s".format(self.sources.name), [source])
+            return set(row[0] for row in cur)
+
+    def get_checkpoint(self, filename, source):
+        """Renvoie le point de reprise d'un fichier partiellement analysé, ou None"""
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT line_offset, log_size, invalid, clean, dirty FROM {} WHERE filename = %s AND source = %s"
+                        .format(self.checkpoints.name), [filename, source])
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(['line_offset', 'log_size', 'invalid', 'clean', 'dirty'], row))
+
+    def set_checkpoint(self, checkpoint):
+        """Enregistre le point de reprise d'un fichier, dans la transaction courante"""
+        self.clear_checkpoint(checkpoint['filename'], checkpoint['source'])
+        self.checkpoints.insert_row(checkpoint)
+
+    def clear_checkpoint(self, filename, source):
+        with self.conn.cursor() as cur:
+            cur.execute("DELETE FROM {} WHERE filename = %s AND source = %s".format(self.checkpoints.name),
+                        [filename, source])
 
     def ship_info(self, imo_number):
         with self.conn.cursor() as cur:
@@ -202,32 +377,38 @@ class AISdb(sql.PgsqlRepository):
             for row in cur:
                 print("MMSI = {} ({} - {})".format(*row))
 
-    def get_messages_for_vessel(self, imo_number, from_ts=None, to_ts=None, use_clean_db=False, as_df=False):
+    def get_messages_for_vessel(self, imo_number, from_ts=None, to_ts=None, use_clean_db=False, as_df=False,
+                                as_batch=False):
+        """Obtient les messages de tous les numéros mmsi du navire pendant leur période d'utilisation (imo_list),
+        triés par horodatage croissant
+
+        Les messages sont lus en une seule requête, par une jointure avec imo_list; from_ts et to_ts bornent
+        en plus la période. Renvoie une liste de dicts, un DataFrame avec as_df ou un MessageBatch avec as_batch."""
         if use_clean_db:
+            db = self.clean
             imo_list = self.imolist
         else:
+            db = self.extended
             imo_list = self.clean_imolist
 
-        where = ["imo_number = {}"]
+        # comme get_message_stream, une borne NULL de la période ne filtre pas
+        where = ["l.imo_number = %s",
+                 "(l.first_seen IS NULL OR m.complete_sys_date >= l.first_seen)",
+                 "(l.last_seen IS NULL OR m.complete_sys_date <= l.last_seen)"]
         params = [imo_number]
+        if not from_ts is None:
+            where.append("m.complete_sys_date >= %s")
+            params.append(from_ts)
+        if not to_ts is None:
+            where.append("m.complete_sys_date <= %s")
+            params.append(to_ts)
 
-        with self.conn.cursor() as cur:
-            cur.execute(
-                "select mmsi, first_seen, last_seen from {} where {}".format(imo_list.name, ' AND '.join(where)).format(
-                    *params))
-            msg_stream = None
-            # obtenir des données pour chacun des numéros mmsi de ce vaisseau, et concat
-            for mmsi, first, last in cur:
-                stream = self.get_message_stream(mmsi, from_ts=first, to_ts=last, use_clean_db=use_clean_db,
-                                                 as_df=as_df)
-                if msg_stream is None:
-                    msg_stream = stream
-                else:
-                    msg_stream = msg_stream + stream
-            return msg_stream
-
-    def get_message_stream(self, mmsi, from_ts=None, to_ts=None, use_clean_db=False, as_df=False):
-        """Obtient le flux de messages pour le mmsi donné, triés par horodatage croissant"""
+        cols_list = ','.join(['m.' + c[0].lower() for c in db.cols])
+        sql = "SELECT {} FROM {} AS m JOIN {} AS l ON m.mmsi = l.mmsi WHERE {} ORDER BY m.complete_sys_date ASC".format(
+            cols_list, db.get_name(), imo_list.get_name(), ' AND '.join(where))
+        return self._fetch_messages(db, sql, params, as_df, as_batch)
+
+    def _message_stream_query(self, mmsi, from_ts=None, to_ts=None, use_clean_db=False):
         # construire une requête de base de données
         if use_clean_db:
             db = self.clean
@@ -246,14 +427,27 @@ class AISdb(sql.PgsqlRepository):
         where_clause = ' AND '.join(where)
         sql = "SELECT {} FROM {} WHERE {} ORDER BY complete_sys_date ASC".format(cols_list,
                                                                     db.get_name(), where_clause)
+        return db, sql, params
 
+    def get_message_stream(self, mmsi, from_ts=None, to_ts=None, use_clean_db=False, as_df=False, as_batch=False):
+        """Obtient le flux de messages pour le mmsi donné, triés par horodatage croissant
+
+        Renvoie une liste de dicts, un DataFrame avec as_df ou un MessageBatch (en colonnes) avec as_batch."""
+        db, sql, params = self._message_stream_query(mmsi, from_ts, to_ts, use_clean_db)
+        return self._fetch_messages(db, sql, params, as_df, as_batch)
+
+    def _fetch_messages(self, db, sql, params, as_df=False, as_batch=False):
+        # exécute une requête sur les colonnes de db, dans la représentation demandée
         if as_df:
             if pd is None:
                 raise RuntimeError("Pandas not Found, Cannot Create Dataframe")
             # créer un cadre de données pandas
+            return self._read_dataframe(db, sql, params)
+
+        elif as_batch:
             with self.conn.cursor() as cur:
-                full_sql = cur.mogrify(sql, params).decode('ascii')
-            return pd.read_sql(full_sql, self.conn, index_col='complete_sys_date', parse_dates=['complete_sys_date'])
+                cur.execute(sql, params)
+                return MessageBatch.from_rows(cur.fetchall(), [col[0] for col in db.cols])
 
         else:
             with self.conn.cursor() as cur:
@@ -268,19 +462,123 @@ class AISdb(sql.PgsqlRepository):
 
                 return msg_stream
 
+    def _read_dataframe(self, db, sql, params):
+        """Lit le résultat de la requête avec COPY (...) TO STDOUT au format csv, analysé par pandas avec le type
+        de chaque colonne: entiers en Int64 (NULL = <NA>), flottants en float64, horodatages en datetime64,
+        texte en object (NULL = NaN). L'index est complete_sys_date.
+
+        NULL est un champ vide non entre guillemets (valeur par défaut de COPY); pandas ne distinguant pas un
+        champ vide entre guillemets, les valeurs texte non NULL sont lues préfixées d'un caractère, retiré ensuite,
+        pour que la chaîne vide et tout autre texte soient relus à l'identique."""
+        dtypes = {}
+        na_values = {}
+        floats = []
+        dates = []
+        texts = []
+        columns = []
+        for name, col_type in db.cols:
+            col = name.lower()
+            col_type = col_type.lower()
+            na_values[col] = ['']
+            if col_type.startswith(DATAFRAME_INTEGER_TYPES):
+                dtypes[col] = 'Int64'
+            elif col_type.startswith('double precision'):
+                # NaN, Infinity et -Infinity sont reconnus par pandas
+                na_values[col].append('NaN')
+                floats.append(col)
+            elif col_type.startswith('timestamp'):
+                dtypes[col] = str
+                dates.append(col)
+            else:
+                dtypes[col] = object
+                texts.append(col)
+                columns.append("'.' || q.\"{0}\" AS \"{0}\"".format(col))
+                continue
+            columns.append('q."{}"'.format(col))
+
+        with self.conn.cursor() as cur:
+            query = cur.mogrify(sql, params).decode('utf-8')
+            buf = io.StringIO()
+            cur.copy_expert("COPY (SELECT {} FROM ({}) AS q) TO STDOUT WITH (FORMAT csv, HEADER)".format(
+                ','.join(columns), query), buf)
+        buf.seek(0)
+
+        df = pd.read_csv(buf, dtype=dtypes, na_values=na_values, keep_default_na=False)
+        for col in texts:
+            # retire le préfixe des valeurs non NULL
+            df[col] = df[col].str[1:]
+        for col in floats:
+            df[col] = df[col].astype('float64')
+        for col in dates:
+            # PostgreSQL omet les fractions de seconde nulles: un format unique, reconnu par toutes les versions
+            # de pandas, est obtenu en ajoutant '.0' aux horodatages sans fraction
+            values = df[col]
+            values = values.where(values.isna() | values.str.contains('.', regex=False), values + '.0')
+            df[col] = pd.to_datetime(values, format='%Y-%m-%d %H:%M:%S.%f')
+        return df.set_index('complete_sys_date')
+
+    def iter_message_stream(self, mmsi, from_ts=None, to_ts=None, use_clean_db=False, batch_size=None,
+                            itersize=ITERSIZE, as_batch=False):
+        """Variante de get_message_stream lue au fur et à mesure avec un curseur nommé (côté serveur).
+
+        Le générateur produit un dict par message, les lignes étant transférées par paquets de itersize ou,
+        avec batch_size, des listes d'au plus batch_size dicts transférées chacune en une fois (des MessageBatch
+        avec as_batch). Le curseur vit dans la transaction courante:
+        le flux doit être consommé avant la validation (commit) ou l'annulation (rollback)."""
+        db, sql, params = self._message_stream_query(mmsi, from_ts, to_ts, use_clean_db)
+        names = [col[0] for col in db.cols]
+        with self.conn.cursor(name="message_stream_{}".format(mmsi)) as cur:
+            cur.itersize = itersize
+            cur.execute(sql, params)
+            if batch_size is None:
+                for row in cur:
+                    yield dict(zip(names, row))
+            else:
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    if as_batch:
+                        yield MessageBatch.from_rows(rows, names)
+                    else:
+                        yield [dict(zip(names, row)) for row in rows]
+
 
 class AISExtendedTable(sql.Table):
+    """Table des messages retenus par shipsimporter, avec leur localisation SIG (colonne location)
+
+    La localisation est calculée selon l'option 'location_mode' du référentiel:
+    'trigger' par un trigger plpgsql appelé pour chaque ligne (compatibilité), 'insert' par la requête
+    d'insertion elle-même (COPY dans une table temporaire puis INSERT ... SELECT), 'generated' par une
+    colonne générée (choisi avant create). backfill_locations calcule les localisations manquantes en masse.
+    """
 
     def __init__(self, db):
+        location_type = 'geography(POINT, 4326)'
+        if db.location_mode == 'generated':
+            location_type = location_type + " GENERATED ALWAYS AS (" + LOCATION_SQL + ") STORED"
+        # la colonne location a son propre index GiST: les index GiST du profil ne sont pas repris
         super(AISExtendedTable, self).__init__(db, 'ais_extended',
-                                               AISdb.clean_db_spec['cols'] + [('location', 'geography(POINT, 4326)')],
-                                               AISdb.clean_db_spec['indices'])
+                                               AISdb.clean_db_spec['cols'] + [('location', location_type)],
+                                               [spec for spec in db.indices if len(spec) < 3 or spec[2] != 'gist'])
+        # table temporaire de chargement du mode 'insert', supprimée à la fin de chaque transaction
+        self.staging = sql.Table(db, self.name + '_staging', self.cols)
 
     def create(self):
         with self.db.conn.cursor() as cur:
             cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
         super(AISExtendedTable, self).create()
+        self.set_location_mode()
+
+    def set_location_mode(self):
+        """Installe le trigger de localisation en mode 'trigger', le supprime sinon"""
         with self.db.conn.cursor() as cur:
+            if self.db.location_mode != 'trigger':
+                logging.info("Dropping Trigger {}_gis_insert (location_mode {})".format(self.name,
+                                                                                   self.db.location_mode))
+                cur.execute("DROP TRIGGER IF EXISTS {0}_gis_insert ON {0}".format(self.name))
+                self.db.conn.commit()
+                return
             # trigger pour la génération de localisation SIG
             try:
                 cur.execute("""CREATE OR REPLACE FUNCTION location_insert() RETURNS trigger AS '
@@ -297,6 +595,62 @@ class AISExtendedTable(sql.Table):
                 self.db.conn.rollback()
         self.db.conn.commit()
 
+    def insert_rowsbatch(self, rows):
+        """ Insère les lignes, en calculant leur localisation dans la requête en mode 'insert'
+
+        Les lignes sont chargées dans une table temporaire (selon 'bulk_mode'), puis copiées dans la table
+        par un seul INSERT ... SELECT qui calcule location pour tout le lot.
+        """
+        if len(rows) == 0:
+            return
+        if self.db.location_mode != 'insert':
+            super(AISExtendedTable, self).insert_rowsbatch(rows)
+            return
+        columns = rows.columns if isinstance(rows, MessageBatch) else list(rows[0].keys())
+        columnlist = ','.join(c.lower() for c in columns)
+        with self.db.conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS " + self.staging.name + " ON COMMIT DROP AS SELECT * FROM " +
+                        self.name + " WITH NO DATA")
+        self.staging.insert_rowsbatch(rows)
+        with self.db.conn.cursor() as cur:
+            cur.execute("INSERT INTO " + self.name + " (" + columnlist + ",location) SELECT " + columnlist + "," +
+                        LOCATION_SQL + " FROM " + self.staging.name)
+            cur.execute("TRUNCATE " + self.staging.name)
+
+    def backfill_locations(self, batch_size=BACKFILL_BATCH):
+        """ Calcule la localisation des lignes qui n'en ont pas (chargées sans trigger, ou avant un changement
+        de 'location_mode') par des UPDATE ensemblistes sur des plages d'identifiants, validés plage par plage
+
+        Renvoie
+        -------
+        Le nombre de lignes mises à jour
+        """
+        if self.db.location_mode == 'generated':
+            logging.info("Locations of {} Are Generated Columns, Nothing to Backfill".format(self.name))
+            return 0
+        start = time.time()
+        with self.db.conn.cursor() as cur:
+            cur.execute("SELECT min(id), max(id) FROM " + self.name + " WHERE location IS NULL")
+            min_id, max_id = cur.fetchone()
+        if min_id is None:
+            logging.info("No Missing Locations in {}".format(self.name))
+            return 0
+        sql_update = "UPDATE " + self.name + " SET location = " + LOCATION_SQL + \
+            " WHERE id >= %s AND id < %s AND location IS NULL AND longitude IS NOT NULL AND latitude IS NOT NULL"
+        count = 0
+        with self.db.conn.cursor() as cur:
+            for low in range(min_id, max_id + 1, batch_size):
+                # le trigger recalculerait chaque ligne une seconde fois, il n'est désactivé que dans la transaction
+                if self.db.location_mode == 'trigger':
+                    cur.execute("ALTER TABLE {0} DISABLE TRIGGER {0}_gis_insert".format(self.name))
+                cur.execute(sql_update, [low, low + batch_size])
+                count = count + cur.rowcount
+                if self.db.location_mode == 'trigger':
+                    cur.execute("ALTER TABLE {0} ENABLE TRIGGER {0}_gis_insert".format(self.name))
+                self.db.conn.commit()
+        logging.info("Computed {} Locations in {} ({:f}s)".format(count, self.name, time.time() - start))
+        return count
+
     def create_indices(self):
         with self.db.conn.cursor() as cur:
             idxn = self.name.lower() + "_location_idx"
@@ -308,6 +662,11 @@ class AISExtendedTable(sql.Table):
                 self.db.conn.rollback()
         super(AISExtendedTable, self).create_indices()
 
+    def index_jobs(self):
+        idxn = self.name.lower() + "_location_idx"
+        return [(self.name, idxn, "CREATE INDEX IF NOT EXISTS \"" + idxn + "\" ON \"" + self.name +
+                 "\" USING GIST(\"location\")")] + super(AISExtendedTable, self).index_jobs()
+
     def drop_indices(self):
         with self.db.conn.cursor() as cur:
             tbl = self.name
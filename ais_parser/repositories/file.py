@@ -1,10 +1,15 @@
 import io
 import logging
 import os
+import queue
+import threading
 import zipfile
 
 EXPORT_COMMANDS = [('status', 'report status of this repository.')]
 
+# taille des blocs décompressés à l'avance (1 Mio)
+PREFETCH_BLOCK = 1 << 20
+
 def load(options, readonly=False):
     assert 'path' in options
 
@@ -23,16 +28,23 @@ def load(options, readonly=False):
     else:
         unzip = False
 
+    # nombre de Mio décompressés à l'avance en arrière-plan, 0 pour une lecture séquentielle
+    if 'prefetch' in options:
+        prefetch = int(options['prefetch'])
+    else:
+        prefetch = 0
+
     return FileRepository(options['path'], allowedExtensions=allowed_extensions,
-                          recursive=recursive, unzip=unzip)
+                          recursive=recursive, unzip=unzip, prefetch=prefetch)
 
 class FileRepository:
 
-    def __init__(self, path, allowedExtensions=None, recursive=True, unzip=False):
+    def __init__(self, path, allowedExtensions=None, recursive=True, unzip=False, prefetch=0):
         self.root = path
         self.allowed_extensions = allowedExtensions
         self.recursive = recursive
         self.unzip = unzip
+        self.prefetch = prefetch
 
     def __enter__(self):
         pass
@@ -43,12 +55,20 @@ class FileRepository:
     def status(self):
         print("Folder at {}".format(self.root))
 
-    def iterfiles(self):
+    def iterfiles(self, skip=None):
         """
         Itérer les fichiers dans ce référentiel de fichiers. Renvoie un générateur de 3 tuples,
         contenant un manipulateur, un nom de fichier et une extension de fichier du fichier actuellement ouvert.
 
+        skip(nom, extension), s'il est donné, renvoie True pour les fichiers (ou membres zip) à ignorer:
+        ils ne sont ni ouverts ni décompressés.
+
+        Avec l'option prefetch, les archives zip sont décompressées dans un thread en arrière-plan
+        pendant l'analyse du fichier courant, au plus prefetch Mio à l'avance.
         """
+        if self.prefetch > 0:
+            yield from self._iterfiles_prefetch(skip)
+            return
         logging.debug("Iterating files in " + self.root)
         failed_files = []
         for root, _, files in os.walk(self.root):
@@ -56,6 +76,8 @@ class FileRepository:
             for filename in files:
                 _, ext = os.path.splitext(filename)
                 if self.allowed_extensions == None or ext in self.allowed_extensions:
+                    if skip is not None and skip(filename, ext):
+                        continue
                     # heurtant des erreurs lors du décodage des données, iso-8859-1 semble les trier
                     with open(os.path.join(root, filename), 'r', encoding='iso-8859-1') as fp:
                         yield (fp, filename, ext)
@@ -66,6 +88,8 @@ class FileRepository:
                             for zname in z.namelist():
                                 _, ext = os.path.splitext(zname)
                                 if self.allowed_extensions == None or ext in self.allowed_extensions:
+                                    if skip is not None and skip(zname, ext):
+                                        continue
                                     with z.open(zname, 'r') as fp:
                                         # zipfile renvoie un fichier binaire, nous avons donc besoin d'un
                                         # TextIOWrapper pour le décoder
@@ -79,5 +103,126 @@ class FileRepository:
         if len(failed_files) > 0:
             logging.warning("Skipped %d Files Due to Errors: %s", len(failed_files), repr(failed_files))
 
+    def _iterfiles_prefetch(self, skip):
+        logging.debug("Iterating files in %s, Prefetching %d MiB", self.root, self.prefetch)
+        failed_files = []
+        blocks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._prefetch_worker, daemon=True, args=(blocks, stop, skip))
+        worker.start()
+        try:
+            while True:
+                item = blocks.get()
+                if item[0] == 'done':
+                    break
+                elif item[0] == 'file':
+                    _, path, filename, ext = item
+                    with open(path, 'r', encoding='iso-8859-1') as fp:
+                        yield (fp, filename, ext)
+                elif item[0] == 'member':
+                    _, zname, ext = item
+                    reader = _BlockReader(blocks)
+                    yield (io.TextIOWrapper(io.BufferedReader(reader), encoding='iso-8859-1'), zname, ext)
+                    # consommer la fin du membre si l'appelant ne l'a pas lu entièrement
+                    reader.drain()
+                elif item[0] == 'failed':
+                    _, filename, error = item
+                    logging.warning("Unable to Extract zip File %s: %s ", filename, error)
+                    failed_files.append(filename)
+        finally:
+            stop.set()
+        if len(failed_files) > 0:
+            logging.warning("Skipped %d Files Due to Errors: %s", len(failed_files), repr(failed_files))
+
+    def _prefetch_worker(self, blocks, stop, skip):
+        """Parcourt le référentiel dans le même ordre que iterfiles et envoie les fichiers à ouvrir
+        et les blocs des membres zip décompressés dans la file bornée blocks."""
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        for root, _, files in os.walk(self.root):
+            for filename in files:
+                _, ext = os.path.splitext(filename)
+                path = os.path.join(root, filename)
+                if self.allowed_extensions == None or ext in self.allowed_extensions:
+                    if skip is not None and skip(filename, ext):
+                        continue
+                    if not put(('file', path, filename, ext)):
+                        return
+                elif self.unzip and ext == '.zip':
+                    try:
+                        with zipfile.ZipFile(path, 'r') as z:
+                            for zname in z.namelist():
+                                _, ext = os.path.splitext(zname)
+                                if self.allowed_extensions == None or ext in self.allowed_extensions:
+                                    if skip is not None and skip(zname, ext):
+                                        continue
+                                    if not put(('member', zname, ext)):
+                                        return
+                                    try:
+                                        with z.open(zname, 'r') as fp:
+                                            block = fp.read(PREFETCH_BLOCK)
+                                            while len(block) > 0:
+                                                if not put(('data', block)):
+                                                    return
+                                                block = fp.read(PREFETCH_BLOCK)
+                                        end = ('end',)
+                                    except (zipfile.BadZipFile, RuntimeError, OSError) as error:
+                                        # l'erreur est levée chez le lecteur du membre
+                                        end = ('error', error)
+                                    if not put(end):
+                                        return
+                    except (zipfile.BadZipFile, RuntimeError) as error:
+                        if not put(('failed', filename, error)):
+                            return
+            if not self.recursive:
+                break
+        put(('done',))
+
     def close(self):
         pass
+
+
+class _BlockReader(io.RawIOBase):
+    """Fichier binaire d'un membre zip, lu depuis les blocs décompressés en arrière-plan."""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.block = memoryview(b'')
+        self.offset = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset == len(self.block):
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if item[0] == 'data':
+                self.block = memoryview(item[1])
+                self.offset = 0
+            else:
+                self.eof = True
+                if item[0] == 'error':
+                    raise item[1]
+        n = min(len(b), len(self.block) - self.offset)
+        b[:n] = self.block[self.offset:self.offset + n]
+        self.offset = self.offset + n
+        return n
+
+    def drain(self):
+        self.block = memoryview(b'')
+        self.offset = 0
+        while not self.eof:
+            item = self.blocks.get()
+            if item[0] != 'data':
+                self.eof = True
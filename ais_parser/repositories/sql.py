@@ -8,11 +8,30 @@ Tableau
 -----
 Utilisé pour encapsuler une table de base de données ais_parser
 
+Table partitionnée
+-----
+Table partitionnée par mois ou par jour, dont les partitions sont créées à l'insertion
+
 """
+import datetime
+import io
 import logging
+import math
+import operator
+import queue
+import struct
+import threading
+import time
 
 import psycopg2
 
+from ais_parser.messages import MessageBatch
+
+# modes d'insertion en masse acceptés par l'option 'bulk_mode' du référentiel
+BULK_MODES = ('insert', 'copy', 'copy_binary')
+# partitionnement des tables par date accepté par l'option 'partitioning' du référentiel
+PARTITION_INTERVALS = ('none', 'monthly', 'daily')
+
 
 def load(options, readonly=False):
     return PgsqlRepository(options)
@@ -34,6 +53,26 @@ class PgsqlRepository(object):
         else:
             self.user = options['user']
             self.password = options['pass']
+        if 'bulk_mode' in options.keys():
+            self.bulk_mode = options['bulk_mode']
+        else:
+            self.bulk_mode = 'insert'
+        if self.bulk_mode not in BULK_MODES:
+            logging.warning("Unknown bulk_mode " + self.bulk_mode + ", Using 'insert' Instead.")
+            self.bulk_mode = 'insert'
+        # construction des index: nombre de connexions en parallèle et paramètres de session
+        if 'index_workers' in options.keys():
+            self.index_workers = max(1, int(options['index_workers']))
+        else:
+            self.index_workers = 1
+        if 'maintenance_work_mem' in options.keys():
+            self.maintenance_work_mem = options['maintenance_work_mem']
+        else:
+            self.maintenance_work_mem = None
+        if 'max_parallel_maintenance_workers' in options.keys():
+            self.max_parallel_maintenance_workers = int(options['max_parallel_maintenance_workers'])
+        else:
+            self.max_parallel_maintenance_workers = None
         self.conn = None
 
     def connection(self):
@@ -45,9 +84,80 @@ class PgsqlRepository(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.conn.close()
 
+    def build_indices(self, tables):
+        """ Crée les index manquants des tables en parallèle, un index par connexion à la fois
+
+        Jusqu'à 'index_workers' connexions sont ouvertes, chacune avec les paramètres de session
+        'maintenance_work_mem' et 'max_parallel_maintenance_workers' s'ils sont configurés. Chaque index est
+        validé dès qu'il est construit; la durée de chaque construction est journalisée.
+
+        Arguments
+        ---------
+        tables: liste
+            Les tables (Table) dont les index sont à créer
+
+        Retourne
+        -------
+        liste des noms des index en erreur
+        """
+        jobs = queue.Queue()
+        for table in tables:
+            for job in table.index_jobs():
+                jobs.put(job)
+        errors = []
+        if jobs.empty():
+            return errors
+        start = time.time()
+        total = jobs.qsize()
+        workers = [threading.Thread(target=self._index_worker, args=(jobs, errors))
+                   for i in range(min(self.index_workers, total))]
+        [t.start() for t in workers]
+        [t.join() for t in workers]
+        # index restés en file si aucune connexion n'a pu être ouverte
+        while not jobs.empty():
+            errors.append(jobs.get_nowait()[1])
+        logging.info("Built %d Indices With %d Connections, %d Errors (%fs)", total - len(errors), len(workers),
+                     len(errors), time.time() - start)
+        return errors
+
+    def _index_worker(self, jobs, errors):
+        try:
+            conn = self.connection()
+        except psycopg2.Error as e:
+            # les index restants sont construits par les autres connexions
+            logging.error("Error Connecting for Index Creation: %s", e)
+            return
+        try:
+            with conn.cursor() as cur:
+                if self.maintenance_work_mem is not None:
+                    cur.execute("SET maintenance_work_mem = %s", [self.maintenance_work_mem])
+                if self.max_parallel_maintenance_workers is not None:
+                    cur.execute("SET max_parallel_maintenance_workers = %s", [self.max_parallel_maintenance_workers])
+                conn.commit()
+                while True:
+                    try:
+                        table, idxn, sql = jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    start = time.time()
+                    try:
+                        cur.execute(sql)
+                        conn.commit()
+                        logging.info("Created Index %s on %s (%fs)", idxn, table, time.time() - start)
+                    except psycopg2.Error as e:
+                        conn.rollback()
+                        logging.error("Error Creating Index %s on %s: %s", idxn, table, e)
+                        errors.append(idxn)
+        finally:
+            conn.close()
+
 
 class Table(object):
     """Table de base de données
+
+    Les index sont décrits par des tuples (nom, colonnes[, méthode[, condition]]): la méthode d'accès
+    ('btree' par défaut, 'brin', 'gist', ...) et la condition WHERE d'un index partiel sont optionnelles,
+    une colonne contenant une parenthèse est une expression (par exemple 'point(longitude, latitude)').
     """
 
     def __init__(self, db, name, cols, indices=None, constraint=None,
@@ -95,22 +205,28 @@ class Table(object):
     def create_indices(self):
         with self.db.conn.cursor() as cur:
             tbl = self.name
-            for idx, cols in self.indices:
-                idxn = tbl.lower() + "_" + idx
+            for spec in self.indices:
+                idxn = tbl.lower() + "_" + spec[0]
                 try:
                     logging.info("CREATING INDEX " + idxn + " on Table " + tbl)
-                    cur.execute("CREATE INDEX \"" + idxn + "\" ON \"" + tbl + "\" USING btree (" +
-                                ','.join(["\"{}\"".format(s.lower()) for s in cols]) + ")")
+                    cur.execute(_index_sql(tbl, idxn, spec))
                 except psycopg2.ProgrammingError:
                     logging.info("Index " + idxn + " Already Exists")
                     self.db.conn.rollback()
             self.db.conn.commit()
 
+    def index_jobs(self):
+        """ Renvoie les index de la table sous la forme (table, nom de l'index, requête CREATE INDEX IF NOT EXISTS)
+        """
+        return [(self.name, self.name.lower() + "_" + spec[0],
+                 _index_sql(self.name, self.name.lower() + "_" + spec[0], spec, if_not_exists=True))
+                for spec in self.indices]
+
     def drop_indices(self):
         with self.db.conn.cursor() as cur:
             tbl = self.name
-            for idx, _ in self.indices:
-                idxn = tbl.lower() + "_" + idx
+            for spec in self.indices:
+                idxn = tbl.lower() + "_" + spec[0]
                 logging.info("Dropping Index: " + idxn + " on Table " + tbl)
                 cur.execute("DROP INDEX IF EXISTS \"" + idxn + "\"")
             self.db.conn.commit()
@@ -170,14 +286,37 @@ class Table(object):
     def insert_rowsbatch(self, rows):
         """ Insère un certain nombre de lignes dans le tableau
 
+        Le chemin utilisé dépend de l'option 'bulk_mode' du référentiel:
+        'copy' et 'copy_binary' passent par COPY ... FROM STDIN, 'insert'
+        construit une requête INSERT ... VALUES avec mogrify.
+
         Arguments
         ---------
-        lignes: liste
-            Une liste de dictionnaires de paires (colonne, valeur)
+        lignes: liste ou MessageBatch
+            Une liste de dictionnaires de paires (colonne, valeur), ou un lot de messages en colonnes
         """
         # vérifiez qu'il y a des lignes dans l'insertion
         if len(rows) == 0:
             return
+        if self.db.bulk_mode == 'copy':
+            self.copy_rowsbatch(rows)
+        elif self.db.bulk_mode == 'copy_binary':
+            self.copy_rowsbatch(rows, binary=True)
+        else:
+            self.mogrify_rowsbatch(rows)
+
+    def mogrify_rowsbatch(self, rows):
+        """ Insère les lignes avec une seule requête INSERT ... VALUES
+
+        Arguments
+        ---------
+        lignes: liste ou MessageBatch
+            Une liste de dictionnaires de paires (colonne, valeur), ou un lot de messages en colonnes
+        """
+        if len(rows) == 0:
+            return
+        if isinstance(rows, MessageBatch):
+            rows = rows.to_dicts()
         # logging.debug("Ligne à insérer: {}". format (lignes [0]))
         with self.db.conn.cursor() as cur:
             columnlist = self._get_list_of_columns(rows[0])
@@ -192,7 +331,377 @@ class Table(object):
             cur.execute("INSERT INTO " + self.name + " " +
                         columnlist + " VALUES " + args)
 
+    def copy_rowsbatch(self, rows, binary=False):
+        """ Insère les lignes avec COPY ... FROM STDIN depuis un tampon en mémoire
+
+        Si une colonne n'a pas d'encodeur binaire (par exemple 'geography'),
+        le format texte est utilisé à la place.
+
+        Arguments
+        ---------
+        lignes: liste ou MessageBatch
+            Une liste de dictionnaires de paires (colonne, valeur), ou un lot de messages en colonnes
+        binaire: bool
+            Utiliser le format binaire de COPY plutôt que le format texte
+        """
+        if len(rows) == 0:
+            return
+        if isinstance(rows, MessageBatch):
+            columns = rows.columns
+            values = rows.itertuples(columns)
+        else:
+            columns = list(rows[0].keys())
+            values = _row_values(rows, columns)
+        if binary:
+            types = self._get_copy_binary_types(columns)
+            if types is None:
+                binary = False
+        if binary:
+            buf = _copy_binary_buffer(values, types)
+            fmt = 'binary'
+        else:
+            buf = _copy_text_buffer(values)
+            fmt = 'text'
+        columnlist = '(' + ','.join([c.lower() for c in columns]) + ')'
+        with self.db.conn.cursor() as cur:
+            cur.copy_expert("COPY " + self.name + " " + columnlist +
+                            " FROM STDIN WITH (FORMAT " + fmt + ")", buf)
+
+    def _get_copy_binary_types(self, columns):
+        """ Obtient l'encodeur binaire de chaque colonne, ou None si une colonne n'est pas prise en charge
+        """
+        col_types = {c[0].lower(): c[1].lower() for c in self.cols}
+        types = []
+        for col in columns:
+            encoder = None
+            col_type = col_types.get(col.lower(), '')
+            for prefix, enc in _COPY_BINARY_ENCODERS:
+                if col_type.startswith(prefix):
+                    encoder = enc
+                    break
+            if encoder is None:
+                return None
+            types.append(encoder)
+        return types
+
     def copy_from_file(self, fname, columns):
         with self.db.conn.cursor() as cur:
             cur.execute("COPY " + self.name + " (" + ','.join(c.lower()
                                                               for c in columns) + ") FROM %s DELIMITER ',' CSV HEADER", [fname])
+
+
+def _copy_text_value(value):
+    """ Convertit une valeur python au format texte de COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    value = str(value)
+    if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+        value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return value
+
+
+class PartitionedTable(Table):
+    """Table partitionnée par intervalles (RANGE) d'une colonne horodatage, une partition par mois ou par jour
+
+    Les partitions sont créées à la demande avant chaque insertion, dans la transaction courante; une partition
+    par défaut reçoit les lignes sans horodatage ou chargées par copy_from_file. La clé primaire d'une colonne
+    (PRIMARY KEY) devient (colonne, colonne de partitionnement), comme l'exige PostgreSQL.
+
+    Les index sont créés sur chaque partition: un chargement en masse (drop_indices, puis create_indices) ne
+    touche pas aux index des partitions existantes, et truncate/drop_partitions suppriment des partitions entières.
+    """
+
+    def __init__(self, db, name, cols, indices=None, constraint=None,
+                 foreign_keys=None, partition_column='Complete_Sys_Date', interval='monthly'):
+        super(PartitionedTable, self).__init__(db, name, cols, indices, constraint, foreign_keys)
+        if interval not in ('monthly', 'daily'):
+            raise ValueError("Unknown Partition Interval " + interval)
+        self.partition_column = partition_column
+        self.interval = interval
+        # index des partitions créées pendant un chargement en masse, différés jusqu'à create_indices
+        self.defer_indices = False
+
+    def create(self):
+        """ Création de la table partitionnée et de sa partition par défaut
+        """
+        with self.db.conn.cursor() as cur:
+            logging.info("CREATING " + self.name + " Table Partitioned " + self.interval.title())
+            columns = []
+            primary_keys = []
+            for c in self.cols:
+                col_type = c[1]
+                if 'PRIMARY KEY' in col_type.upper():
+                    col_type = col_type[:col_type.upper().index('PRIMARY KEY')].strip()
+                    primary_keys.append(c[0].lower())
+                columns.append("\"{}\" {}".format(c[0].lower(), col_type))
+            constraint = list(self.constraint)
+            if len(primary_keys) > 0:
+                constraint.append("PRIMARY KEY (" + ','.join("\"{}\"".format(c) for c in
+                                                             primary_keys + [self.partition_column.lower()]) + ")")
+            cur.execute("CREATE TABLE IF NOT EXISTS \"" + self.name + "\" (" + ','.join(columns + constraint) +
+                        ") PARTITION BY RANGE (\"" + self.partition_column.lower() + "\")")
+            cur.execute("CREATE TABLE IF NOT EXISTS \"" + self.name + "_default\" PARTITION OF \"" + self.name +
+                        "\" DEFAULT")
+            self.db.conn.commit()
+
+        self.create_indices()
+
+    def partition_start(self, timestamp):
+        """Début de la partition contenant l'horodatage"""
+        if self.interval == 'daily':
+            return datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+        return datetime.datetime(timestamp.year, timestamp.month, 1)
+
+    def partition_end(self, start):
+        """Fin (exclue) de la partition commençant à start"""
+        if self.interval == 'daily':
+            return start + datetime.timedelta(days=1)
+        if start.month == 12:
+            return datetime.datetime(start.year + 1, 1, 1)
+        return datetime.datetime(start.year, start.month + 1, 1)
+
+    def partition_name(self, start):
+        if self.interval == 'daily':
+            return "{}_p{:%Y%m%d}".format(self.name, start)
+        return "{}_p{:%Y%m}".format(self.name, start)
+
+    def partitions(self):
+        """ Renvoie la liste triée des partitions (nom, début, fin), sans la partition par défaut
+        """
+        with self.db.conn.cursor() as cur:
+            cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", [self.name])
+            names = [row[0] for row in cur]
+        fmt = '%Y%m%d' if self.interval == 'daily' else '%Y%m'
+        partitions = []
+        for name in names:
+            suffix = name[len(self.name) + 2:]
+            try:
+                start = datetime.datetime.strptime(suffix, fmt)
+            except ValueError:
+                continue
+            partitions.append((name, start, self.partition_end(start)))
+        return sorted(partitions, key=lambda p: p[1])
+
+    def create_partitions(self, timestamps):
+        """ Crée les partitions manquantes pour ces horodatages, dans la transaction courante
+
+        Les partitions existantes sont recherchées dans le catalogue à chaque appel: une partition créée
+        dans une transaction annulée est recréée par l'insertion suivante.
+        """
+        starts = {}
+        for timestamp in set(timestamps):
+            if timestamp is not None:
+                start = self.partition_start(timestamp)
+                starts[self.partition_name(start)] = start
+        if len(starts) == 0:
+            return
+        with self.db.conn.cursor() as cur:
+            cur.execute("SELECT name FROM unnest(%s) AS name WHERE to_regclass(quote_ident(name)) IS NULL",
+                        [sorted(starts)])
+            missing = [row[0] for row in cur]
+            for name in missing:
+                start = starts[name]
+                logging.info("Creating Partition " + name + " of Table " + self.name)
+                cur.execute("CREATE TABLE IF NOT EXISTS \"" + name + "\" PARTITION OF \"" + self.name +
+                            "\" FOR VALUES FROM ('{:%Y-%m-%d %H:%M:%S}') TO ('{:%Y-%m-%d %H:%M:%S}')".format(
+                                start, self.partition_end(start)))
+        if not self.defer_indices:
+            for name in missing:
+                self._create_partition_indices(name)
+
+    def _create_partition_indices(self, partition):
+        with self.db.conn.cursor() as cur:
+            for spec in self.indices:
+                idxn = partition.lower() + "_" + spec[0]
+                cur.execute(_index_sql(partition, idxn, spec, if_not_exists=True))
+
+    def partition_names(self, partitions=None):
+        """ Renvoie les noms des partitions données, ou de toutes les partitions dont la partition par défaut
+        """
+        if partitions is None:
+            return [p[0] for p in self.partitions()] + [self.name + "_default"]
+        return list(partitions)
+
+    def create_indices(self, partitions=None):
+        """ Crée les index manquants des partitions données (noms), ou de toutes les partitions, et met fin
+        au chargement en masse
+        """
+        with self.db.conn.cursor() as cur:
+            for partition, idxn, sql in self.index_jobs(partitions):
+                logging.info("CREATING INDEX " + idxn + " on Partition " + partition)
+                cur.execute(sql)
+        self.db.conn.commit()
+
+    def index_jobs(self, partitions=None):
+        """ Renvoie les index manquants des partitions (partition, nom de l'index, requête), et met fin
+        au chargement en masse
+        """
+        self.defer_indices = False
+        names = self.partition_names(partitions)
+        with self.db.conn.cursor() as cur:
+            cur.execute("SELECT tablename, indexname FROM pg_indexes WHERE tablename = ANY(%s)", [names])
+            existing = set(cur.fetchall())
+        self.db.conn.commit()
+        jobs = []
+        for name in names:
+            for spec in self.indices:
+                idxn = name.lower() + "_" + spec[0]
+                if (name, idxn) not in existing:
+                    jobs.append((name, idxn, _index_sql(name, idxn, spec, if_not_exists=True)))
+        return jobs
+
+    def drop_indices(self, partitions=None):
+        """ Supprime les index des partitions données (noms). Sans liste, commence un chargement en masse:
+        les partitions existantes gardent leurs index, celles créées ensuite n'en ont pas jusqu'à create_indices
+        """
+        if partitions is None:
+            logging.info("Deferring Indices of New Partitions of Table " + self.name)
+            self.defer_indices = True
+            return
+        with self.db.conn.cursor() as cur:
+            for name in partitions:
+                for spec in self.indices:
+                    idxn = name.lower() + "_" + spec[0]
+                    logging.info("Dropping Index: " + idxn + " on Partition " + name)
+                    cur.execute("DROP INDEX IF EXISTS \"" + idxn + "\"")
+            self.db.conn.commit()
+
+    def truncate(self, partitions=None):
+        """Supprimez toutes les données des partitions données (noms), ou de toute la table."""
+        if partitions is None:
+            return super(PartitionedTable, self).truncate()
+        with self.db.conn.cursor() as cur:
+            for name in partitions:
+                logging.info("Truncating Partition " + name)
+                cur.execute("TRUNCATE TABLE \"" + name + "\"")
+            self.db.conn.commit()
+
+    def drop_partitions(self, before):
+        """ Supprime les partitions se terminant au plus tard à la date before, et renvoie leurs noms
+        """
+        dropped = [name for name, _, end in self.partitions() if end <= before]
+        with self.db.conn.cursor() as cur:
+            for name in dropped:
+                logging.info("Dropping Partition " + name)
+                cur.execute("DROP TABLE IF EXISTS \"" + name + "\"")
+            self.db.conn.commit()
+        return dropped
+
+    def insert_row(self, data):
+        self.create_partitions([data.get(self.partition_column)])
+        super(PartitionedTable, self).insert_row(data)
+
+    def insert_rowsbatch(self, rows):
+        if len(rows) == 0:
+            return
+        if isinstance(rows, MessageBatch):
+            self.create_partitions(rows.column(self.partition_column))
+        else:
+            self.create_partitions([row[self.partition_column] for row in rows])
+        super(PartitionedTable, self).insert_rowsbatch(rows)
+
+
+def _index_sql(table, idxn, spec, if_not_exists=False):
+    """ Construit la requête CREATE INDEX d'un index (nom, colonnes[, méthode[, condition]])"""
+    method = spec[2] if len(spec) > 2 else 'btree'
+    columns = ','.join(['(' + c + ')' if '(' in c else '"{}"'.format(c.lower()) for c in spec[1]])
+    sql = "CREATE INDEX " + ("IF NOT EXISTS " if if_not_exists else "") + "\"" + idxn + "\" ON \"" + table + \
+        "\" USING " + method + " (" + columns + ")"
+    if len(spec) > 3 and spec[3]:
+        sql = sql + " WHERE " + spec[3]
+    return sql
+
+
+def _row_values(rows, columns):
+    """ Génère les tuples de valeurs des dicts dans l'ordre de columns"""
+    if len(columns) == 1:
+        return ((row[columns[0]],) for row in rows)
+    return map(operator.itemgetter(*columns), rows)
+
+
+def _copy_text_buffer(rows):
+    """ Construit un tampon au format texte de COPY (tabulations, NULL = \\N) à partir de tuples de valeurs"""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join([_copy_text_value(value) for value in row]))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+
+# époque des horodatages postgreSQL en format binaire
+_PG_EPOCH = datetime.datetime(2000, 1, 1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+_INT2 = struct.Struct('>ih')
+_INT4 = struct.Struct('>ii')
+_INT8 = struct.Struct('>iq')
+_FLOAT8 = struct.Struct('>id')
+_FIELD_LENGTH = struct.Struct('>i')
+_FIELD_COUNT = struct.Struct('>h')
+_NULL_FIELD = _FIELD_LENGTH.pack(-1)
+
+
+def _encode_int2(value):
+    return _INT2.pack(2, value)
+
+
+def _encode_int4(value):
+    return _INT4.pack(4, value)
+
+
+def _encode_int8(value):
+    return _INT8.pack(8, value)
+
+
+def _encode_float8(value):
+    return _FLOAT8.pack(8, value)
+
+
+def _encode_timestamp(value):
+    return _INT8.pack(8, (value - _PG_EPOCH) // _ONE_MICROSECOND)
+
+
+def _encode_text(value):
+    data = str(value).encode('utf-8')
+    return _FIELD_LENGTH.pack(len(data)) + data
+
+
+# préfixes des types de colonne (tels qu'écrits dans les spécifications des tables) et leurs encodeurs binaires
+_COPY_BINARY_ENCODERS = [
+    ('smallint', _encode_int2),
+    ('integer', _encode_int4),
+    ('serial', _encode_int4),
+    ('bigint', _encode_int8),
+    ('bigserial', _encode_int8),
+    ('double precision', _encode_float8),
+    ('timestamp without time zone', _encode_timestamp),
+    ('character varying', _encode_text),
+    ('text', _encode_text)
+]
+
+
+def _copy_binary_buffer(rows, encoders):
+    """ Construit un tampon au format binaire de COPY (en-tête PGCOPY, champs big-endian) à partir de tuples
+    de valeurs"""
+    buf = io.BytesIO()
+    buf.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+    field_count = _FIELD_COUNT.pack(len(encoders))
+    for row in rows:
+        buf.write(field_count)
+        for value, encode in zip(row, encoders):
+            buf.write(_NULL_FIELD if value is None else encode(value))
+    buf.write(_FIELD_COUNT.pack(-1))
+    buf.seek(0)
+    return buf
@@ -0,0 +1,96 @@
+"""Banc d'essai des fonctions de distance de utils sur des trajectoires AIS
+
+Compare, sur les paires de positions consécutives de chaque MMSI d'un ou plusieurs
+fichiers csv AIS, la vitesse et l'erreur de chaque fonction de DISTANCE_BACKENDS
+par rapport à la distance géodésique, puis les décisions de la détection des
+positions aberrantes.
+
+    python -m ais_parser.tools.distance_benchmark fichier.csv [fichier.csv ...]
+
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from ais_parser import utils
+
+
+def read_tracks(paths):
+    """Lit les positions valides des fichiers csv, triées par MMSI puis par horodatage."""
+    frames = []
+    for path in paths:
+        df = pd.read_csv(path, sep=';', encoding='iso-8859-1', dtype=str,
+                         usecols=['MMSI', 'Complete_Sys_Date', 'Longitude', 'Latitude'])
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    # les valeurs non valides deviennent NaN ou NaT et sont ignorées
+    for col in ['Latitude', 'Longitude']:
+        df[col] = pd.to_numeric(df[col].str.replace(',', '.'), errors='coerce')
+    df['Complete_Sys_Date'] = pd.to_datetime(df['Complete_Sys_Date'], format=utils.SYSDATE_FORMAT, errors='coerce')
+    df = df[df['Latitude'].between(-90, 90) & df['Longitude'].between(-180, 180)]
+    return df.dropna().sort_values(['MMSI', 'Complete_Sys_Date'], kind='mergesort')
+
+
+def consecutive_pairs(df):
+    """Renvoie les tableaux (lat1, lon1, lat2, lon2) des positions consécutives d'un même MMSI."""
+    same = (df['MMSI'].values[1:] == df['MMSI'].values[:-1])
+    lat = df['Latitude'].values
+    lon = df['Longitude'].values
+    return lat[:-1][same], lon[:-1][same], lat[1:][same], lon[1:][same]
+
+
+def benchmark_distances(pairs, sample):
+    rng = np.random.default_rng(0)
+    if len(pairs[0]) > sample:
+        idx = rng.choice(len(pairs[0]), sample, replace=False)
+        pairs = [a[idx] for a in pairs]
+    results = {}
+    for name, backend in utils.DISTANCE_BACKENDS.items():
+        start = time.time()
+        results[name] = (backend(*pairs), time.time() - start)
+    reference = results['geodesic'][0]
+    print("{} Consecutive Position Pairs".format(len(reference)))
+    print("{:16} {:>12} {:>14} {:>14} {:>12}".format('Backend', 'us/Pair', 'Max Abs (m)', 'Max Rel', 'Bound'))
+    for name, (dist, duration) in results.items():
+        error = np.abs(dist - reference)
+        rel = error[reference > 1] / reference[reference > 1]
+        print("{:16} {:>12.3f} {:>14.4f} {:>14.2e} {:>12.1e}".format(
+            name, 1e6 * duration / max(len(dist), 1), error.max() if len(error) else 0.0,
+            rel.max() if len(rel) else 0.0, utils.DISTANCE_ERRORS[name]))
+    print("(equirectangular: Bound Valid for Hops Under 10 km Between Latitudes -80 and 80)")
+
+
+def benchmark_outliers(df):
+    tracks = [(g['Latitude'].values, g['Longitude'].values, g['Complete_Sys_Date'].values)
+              for _, g in df.groupby('MMSI', sort=False)]
+    reference = None
+    print("{} Tracks".format(len(tracks)))
+    print("{:16} {:>12} {:>12} {:>12}".format('Backend', 'Seconds', 'Outliers', 'Differences'))
+    for name in utils.DISTANCE_BACKENDS:
+        start = time.time()
+        masks = [utils.detect_locationoutliers_arrays(*track, distance=name) for track in tracks]
+        duration = time.time() - start
+        mask = np.concatenate(masks) if masks else np.zeros(0, dtype=bool)
+        if reference is None:
+            reference = mask
+        print("{:16} {:>12.3f} {:>12d} {:>12d}".format(name, duration, int(mask.sum()),
+                                                       int((mask != reference).sum())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Distance Backends on AIS Tracks.')
+    parser.add_argument('files', nargs='+', help='AIS CSV Files')
+    parser.add_argument('--sample', type=int, default=100000,
+                        help='Number of Position Pairs Used to Compare Distances (Default 100000).')
+    args = parser.parse_args()
+
+    df = read_tracks(args.files)
+    benchmark_distances(consecutive_pairs(df), args.sample)
+    print()
+    benchmark_outliers(df)
+
+
+if __name__ == '__main__':
+    main()
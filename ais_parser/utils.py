@@ -1,9 +1,66 @@
 import datetime
+import functools
+import logging
+import multiprocessing
 from typing import List
 
 from geographiclib.geodesic import Geodesic
 from geopy.distance import distance
 
+from ais_parser.messages import MessageBatch
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    logging.warn("No pandas found")
+    np = None
+    pd = None
+
+
+# format des horodatages Complete_Sys_Date des fichiers AIS
+SYSDATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+# nombre de chaînes d'horodatage complètes mémorisées par cached_parse_sysdate
+SYSDATE_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=1024)
+def _sysdate_day(date_str):
+    # la partie date (jj/mm/aaaa) est mémorisée, un fichier AIS ne couvre que quelques jours
+    return int(date_str[6:10]), int(date_str[3:5]), int(date_str[0:2])
+
+
+def parse_sysdate(s):
+    """Analyse un horodatage 'jj/mm/aaaa HH:MM:SS', équivalent à datetime.strptime(s, SYSDATE_FORMAT).
+
+    Les champs de la disposition fixe sont découpés directement; toute autre forme (champs à un chiffre,
+    espaces...) ou valeur hors limites est confiée à strptime, qui renvoie le même résultat ou lève
+    la même erreur."""
+    if len(s) == 19 and s[2] == '/' and s[5] == '/' and s[10] == ' ' and s[13] == ':' and s[16] == ':':
+        digits = s[0:2] + s[3:5] + s[6:10] + s[11:13] + s[14:16] + s[17:19]
+        if digits.isdigit() and digits.isascii():
+            year, month, day = _sysdate_day(s[0:10])
+            try:
+                return datetime.datetime(year, month, day, int(s[11:13]), int(s[14:16]), int(s[17:19]))
+            except ValueError:
+                pass
+    return datetime.datetime.strptime(s, SYSDATE_FORMAT)
+
+
+# les fichiers AIS contiennent de longues suites d'horodatages identiques (résolution à la seconde)
+cached_parse_sysdate = functools.lru_cache(maxsize=SYSDATE_CACHE_SIZE)(parse_sysdate)
+
+
+def parse_sysdates(values):
+    """Analyse une série pandas d'horodatages 'jj/mm/aaaa HH:MM:SS'.
+
+    Chaque valeur distincte n'est analysée qu'une fois avec cached_parse_sysdate, les valeurs manquantes
+    deviennent NaT. Renvoie une série datetime64 avec le même index."""
+    codes, uniques = pd.factorize(values)
+    parsed = np.array([cached_parse_sysdate(v) for v in uniques] + [None], dtype='datetime64[ns]')
+    # le code -1 (valeur manquante) désigne le dernier élément, NaT
+    return pd.Series(parsed[codes], index=values.index)
+
 
 def valid_mmsi(mmsi):
 
@@ -72,13 +129,8 @@ def is_validheading(heading):
 def speed_calc(msg_stream, index1, index2):
 
     timediff = abs(msg_stream[index2]['Complete_Sys_Date'] - msg_stream[index1]['Complete_Sys_Date'])
-    try:
-        dist = distance((msg_stream[index1]['Latitude'], msg_stream[index1]['Longitude']),
-                        (msg_stream[index2]['Latitude'], msg_stream[index2]['Longitude'])).m
-    except ValueError:
-        dist = Geodesic.WGS84.Inverse(msg_stream[index1]['Latitude'], msg_stream[index1]['Longitude'],
-                                      msg_stream[index2]['Latitude'], msg_stream[index2]['Longitude'])[
-            's12']  # en mètres
+    dist = geodesic_distance(msg_stream[index1]['Latitude'], msg_stream[index1]['Longitude'],
+                             msg_stream[index2]['Latitude'], msg_stream[index2]['Longitude'])
     if timediff > datetime.timedelta(0):
         convert_metres_to_nautical_miles = 0.0005399568
         speed = (dist * convert_metres_to_nautical_miles) / (timediff.days * 24 + timediff.seconds / 3600)
@@ -87,11 +139,366 @@ def speed_calc(msg_stream, index1, index2):
     return timediff, dist, speed
 
 
-def detect_locationoutliers(msg_stream, as_df=False):
+def geodesic_distance(lat1, lon1, lat2, lon2):
+    """Distance géodésique (m) sur l'ellipsoïde WGS84 entre deux positions."""
+    try:
+        return distance((lat1, lon1), (lat2, lon2)).m
+    except ValueError:
+        return Geodesic.WGS84.Inverse(lat1, lon1, lat2, lon2)['s12']  # en mètres
+
+
+# seuils de detect_locationoutliers: écart de temps (µs), distance (m) et vitesse (noeuds)
+OUTLIER_MAX_TIMEDIFF = 215 * 3600 * 1000000
+OUTLIER_MIN_DISTANCE = 100
+OUTLIER_MAX_SPEED = 50
+METRES_TO_NAUTICAL_MILES = 0.0005399568
+# rayon moyen de la Terre (m) pour la distance haversine
+EARTH_RADIUS = 6371008.8
+# écart relatif entre les distances haversine et géodésique (< 0.6 %) en deçà duquel une décision
+# proche d'un seuil est vérifiée avec la distance géodésique
+OUTLIER_REFINE_MARGIN = 0.02
+
+
+# ellipsoïde WGS84
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+
+def geodesic_distances(lat1, lon1, lat2, lon2):
+    """Distances géodésiques (m) sur l'ellipsoïde WGS84 entre des tableaux de positions (degrés).
+
+    Solution exacte de Karney (geographiclib), calculée position par position."""
+    return np.array([geodesic_distance(*pair) for pair in zip(*[np.asarray(a, dtype=np.float64).tolist()
+                                                                for a in (lat1, lon1, lat2, lon2)])],
+                    dtype=np.float64).reshape(np.shape(lat1))
+
+
+def vincenty_distances(lat1, lon1, lat2, lon2, iterations=200, tolerance=1e-12):
+    """Distances (m) sur l'ellipsoïde WGS84 par la formule inverse de Vincenty, sur des tableaux.
+
+    Précise au millimètre près, erreur relative inférieure à 5e-8 (environ 4e-8 mesurée sur des écarts
+    de moins d'un kilomètre); les paires pour lesquelles l'itération ne converge pas (positions
+    presque antipodales) sont calculées avec geodesic_distance."""
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2)]
+    f = WGS84_F
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    big_l = lon2 - lon1
+    lam = big_l
+    converged = np.zeros(np.shape(lam), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_u2 * sin_lam) ** 2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam) ** 2)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # lignes équatoriales: cos2_alpha = 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            previous = lam
+            lam = big_l + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - previous) <= tolerance
+            if np.all(converged | ~np.isfinite(lam)):
+                break
+        u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        dist = WGS84_B * big_a * (sigma - delta_sigma)
+    dist = np.where(sin_sigma == 0, 0.0, dist)
+    for i in zip(*np.nonzero(~converged & np.isfinite(lam))):
+        dist[i] = geodesic_distance(np.degrees(lat1[i]), np.degrees(lon1[i]), np.degrees(lat2[i]), np.degrees(lon2[i]))
+    return dist
+
+
+def haversine_distances(lat1, lon1, lat2, lon2):
+    """Distances (m) sur la sphère de rayon EARTH_RADIUS entre des tableaux de positions (degrés).
+
+    Erreur relative par rapport à la distance géodésique WGS84 inférieure à 0.6 %."""
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def equirectangular_distances(lat1, lon1, lat2, lon2):
+    """Distances (m) par projection équirectangulaire locale, pour des positions proches (degrés).
+
+    Erreur relative par rapport à la distance géodésique WGS84 inférieure à 0.7 % pour des écarts de
+    moins de 10 km entre les latitudes -80 et 80; elle croît avec la distance et vers les pôles."""
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2)]
+    # écart de longitude ramené dans [-pi, pi] (antiméridien)
+    dlon = (lon2 - lon1 + np.pi) % (2 * np.pi) - np.pi
+    x = dlon * np.cos((lat1 + lat2) / 2)
+    return EARTH_RADIUS * np.hypot(x, lat2 - lat1)
+
+
+# fonctions de distance sur des tableaux, et erreur relative maximale par rapport à la distance géodésique
+DISTANCE_BACKENDS = {'geodesic': geodesic_distances,
+                     'vincenty': vincenty_distances,
+                     'haversine': haversine_distances,
+                     'equirectangular': equirectangular_distances}
+DISTANCE_ERRORS = {'geodesic': 0.0,
+                   # mesurée jusqu'à environ 4e-8 sur des écarts de 1 m à 1 km, moins de 1e-9 au-delà
+                   'vincenty': 5e-8,
+                   'haversine': 0.006,
+                   'equirectangular': 0.007}
+
+
+def _outlier_flags(timediff, dist):
+    # (écart de temps trop long, distance faible, vitesse excessive, vitesse acceptable), comme speed_calc;
+    # avec une distance NaN la vitesse n'est ni excessive ni acceptable
+    far = timediff > OUTLIER_MAX_TIMEDIFF
+    near = dist < OUTLIER_MIN_DISTANCE
+    if timediff > 0:
+        days, rest = divmod(timediff, 86400 * 1000000)
+        speed = (dist * METRES_TO_NAUTICAL_MILES) / (days * 24 + (rest // 1000000) / 3600)
+    else:
+        speed = 102.2
+    return far, near, speed > OUTLIER_MAX_SPEED, speed <= OUTLIER_MAX_SPEED
+
+
+def detect_locationoutliers_arrays(latitudes, longitudes, times, located=None, distance='geodesic'):
+    """Détection des positions aberrantes sur des tableaux, même résultat que detect_locationoutliers.
+
+    Arguments
+    ---------
+    latitudes, longitudes: tableaux de positions en degrés, NaN pour une position absente
+    times: tableau datetime64 ou secondes depuis l'époque, trié par ordre croissant
+    located: masque des lignes ayant une position, par défaut celles dont ni la latitude ni la longitude ne sont NaN
+    distance: nom de la fonction de distance dans DISTANCE_BACKENDS ('geodesic' par défaut, comme speed_calc)
+
+    Les distances et vitesses entre positions consécutives sont calculées en une fois avec la formule
+    haversine; avec une fonction de distance plus précise ('geodesic', 'vincenty'), les paires proches
+    des seuils de 100 m et de 50 noeuds sont recalculées avec celle-ci, les décisions sont donc identiques
+    (avec 'vincenty', à une erreur relative de 5e-8 près sur la distance, voir DISTANCE_ERRORS).
+    Avec 'haversine' ou 'equirectangular' les décisions proches des seuils peuvent différer (voir
+    DISTANCE_ERRORS). La machine à états séquentielle n'est parcourue que si une paire dépasse la vitesse
+    maximale.
+
+    Renvoie un tableau de booléens, True pour les positions aberrantes."""
+    return _locationoutliers(latitudes, longitudes, times, located, distance)[0]
+
+
+def _locationoutliers(latitudes, longitudes, times, located=None, distance='geodesic', at_start=True, final=True):
+    # avec final=False, le flux continue: la machine à états s'arrête sur la première décision qui dépend
+    # des messages suivants. Renvoie (positions aberrantes, lignes en attente, at_start): les lignes en attente
+    # (une ou deux positions) et at_start permettent de reprendre avec le lot suivant.
+    lat = np.asarray(latitudes, dtype=np.float64)
+    lon = np.asarray(longitudes, dtype=np.float64)
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        micros = times.astype('datetime64[us]').astype(np.int64)
+    else:
+        micros = np.round(times.astype(np.float64) * 1000000).astype(np.int64)
+    if located is None:
+        located = ~np.isnan(lat) & ~np.isnan(lon)
+    positions = np.flatnonzero(located)
+    outliers = np.zeros(len(lat), dtype=bool)
+    if len(positions) < 2:  # aucun message pouvant être aberrant disponible
+        return outliers, ([] if final else positions.tolist()), at_start
+    lat = lat[positions]
+    lon = lon[positions]
+    micros = micros[positions]
+
+    exact = DISTANCE_BACKENDS[distance]
+    # les fonctions plus précises que haversine ne sont appelées que pour les paires proches des seuils
+    screen = DISTANCE_ERRORS[distance] < DISTANCE_ERRORS['haversine']
+
+    def pair_distance(a, b):
+        return float(exact(lat[a:a + 1], lon[a:a + 1], lat[b:b + 1], lon[b:b + 1])[0])
+
+    # paires de positions consécutives
+    timediff = np.abs(np.diff(micros))
+    days, rest = np.divmod(timediff, 86400 * 1000000)
+    hours = days * 24 + (rest // 1000000) / 3600
+    dist = (haversine_distances if screen else exact)(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(timediff > 0, (dist * METRES_TO_NAUTICAL_MILES) / hours, 102.2)
+        # distance parcourue à la vitesse maximale
+        max_dist = OUTLIER_MAX_SPEED * hours / METRES_TO_NAUTICAL_MILES
+        far = timediff > OUTLIER_MAX_TIMEDIFF
+        near = dist < OUTLIER_MIN_DISTANCE
+        fast = speed > OUTLIER_MAX_SPEED
+        slow = speed <= OUTLIER_MAX_SPEED
+        # positions hors des bornes: la distance géodésique peut ne pas être définie
+        bounds = (np.abs(lat) > 90) | (np.abs(lon) > 180)
+        refine = screen & ~far & (~np.isfinite(dist) | bounds[:-1] | bounds[1:] |
+                                  (np.abs(dist - OUTLIER_MIN_DISTANCE) <= OUTLIER_REFINE_MARGIN * OUTLIER_MIN_DISTANCE) |
+                                  ((timediff > 0) & (np.abs(dist - max_dist) <= OUTLIER_REFINE_MARGIN * max_dist)))
+        # écart de moins d'une seconde: speed_calc divise par zéro, la paire est évaluée à la demande
+        lazy = set(np.flatnonzero((timediff > 0) & (hours == 0)).tolist())
+        refine[list(lazy)] = False
+    refine = np.flatnonzero(refine)
+    if len(refine) > 0:
+        refined = exact(lat[refine], lon[refine], lat[refine + 1], lon[refine + 1])
+        for i, d in zip(refine.tolist(), refined.tolist()):
+            far[i], near[i], fast[i], slow[i] = _outlier_flags(int(timediff[i]), d)
+
+    # sans paire trop rapide, aucune position n'est aberrante
+    if not np.any(fast & ~near & ~far):
+        if final:
+            return outliers, [], at_start
+        # at_start dépend de la dernière paire qui n'est pas une distance faible
+        moved = np.flatnonzero(far | ~near)
+        if len(moved) > 0:
+            at_start = bool(far[moved[-1]])
+        return outliers, [int(positions[-1])], at_start
+
+    far = far.tolist()
+    near = near.tolist()
+    fast = fast.tolist()
+    slow = slow.tolist()
+
+    def flags(a, b):
+        if b == a + 1 and a not in lazy:
+            return far[a], near[a], fast[a], slow[a]
+        return _outlier_flags(abs(int(micros[b]) - int(micros[a])), pair_distance(a, b))
+
+    # liste chaînée des positions, les positions aberrantes en sont retirées
+    n = len(positions)
+    linked = list(range(1, n)) + [None]
+    outlier = [False] * n
+    index = 0
+    while linked[index] is not None:
+        following = linked[index]
+        too_long, too_close, too_fast, _ = flags(index, following)
+        if too_long:
+            index = following
+            at_start = True  # redémarrer
+        elif too_close:
+            index = following  # sauter l'écart (at_start reste le même)
+        elif too_fast:
+            if at_start is False:
+                outlier[following] = True
+                linked[index] = linked[following]
+            elif linked[following] is None:  # pas de message suivant
+                if not final:
+                    pending = [index, following]
+                    break
+                outlier[index] = True
+                outlier[following] = True
+                index = following
+            else:  # explorez les trois premiers messages A, B, C (at_start est True)
+                indexA = index
+                indexB = following
+                indexC = linked[indexB]
+                longAC, closeAC, _, slowAC = flags(indexA, indexC)
+                longBC, closeBC, _, slowBC = flags(indexB, indexC)
+                # si le test de vitesse A-> C ok ou la distance est petite, alors B est aberrant
+                if not longAC and (closeAC or slowAC):
+                    outlier[indexB] = True
+                    at_start = False
+                # sinon si B-> C ok, alors A est aberrant
+                elif not longBC and (closeBC or slowBC):
+                    outlier[indexA] = True
+                    at_start = False
+                else:
+                    outlier[indexA] = True
+                    outlier[indexB] = True
+                    at_start = True
+                index = indexC
+        else:  # tout est bon
+            index = following
+            at_start = False
+    else:
+        pending = [index]
+
+    outliers[positions[np.array(outlier)]] = True
+    return outliers, ([] if final else positions[pending].tolist()), at_start
+
 
-    if as_df:
-        raise NotImplementedError('msg_stream Cannot be DataFrame, as_df=True Does not Work Yet.')
+def detect_locationoutliers(msg_stream, as_df=False, distance='geodesic'):
+    """Détecte les positions aberrantes d'un flux de messages trié par horodatage.
 
+    msg_stream est une liste de dicts (Latitude, Longitude, Complete_Sys_Date), un MessageBatch ou, avec
+    as_df=True, un DataFrame de get_message_stream (colonnes latitude, longitude, index complete_sys_date).
+    distance choisit la fonction de distance (voir detect_locationoutliers_arrays); sans NumPy, speed_calc
+    est utilisée. Renvoie une liste de booléens, un tableau de booléens pour un MessageBatch, ou une série
+    alignée sur le DataFrame."""
+    if as_df:
+        if pd is None:
+            raise RuntimeError("Pandas not Found, Cannot Use a Dataframe")
+        if 'complete_sys_date' in msg_stream.columns:
+            times = msg_stream['complete_sys_date'].values
+        else:
+            times = msg_stream.index.values
+        mask = detect_locationoutliers_arrays(msg_stream['latitude'].values, msg_stream['longitude'].values, times,
+                                              distance=distance)
+        return pd.Series(mask, index=msg_stream.index)
+
+    if isinstance(msg_stream, MessageBatch):
+        return _locationoutliers(*_message_arrays(msg_stream), distance=distance)[0]
+
+    if np is None:
+        return _detect_locationoutliers_rows(msg_stream)
+
+    return _locationoutliers(*_message_arrays(msg_stream), distance=distance)[0].tolist()
+
+
+def _message_arrays(msg_stream):
+    # (latitudes, longitudes, horodatages, lignes ayant une position) d'une liste de messages ou d'un lot
+    if isinstance(msg_stream, MessageBatch):
+        located = ~msg_stream.nulls['Longitude'] & ~msg_stream.nulls['Latitude']
+        times = msg_stream['Complete_Sys_Date'].astype('datetime64[us]')
+        return msg_stream.floats('Latitude'), msg_stream.floats('Longitude'), times, located
+    located = np.array([row['Longitude'] is not None and row['Latitude'] is not None for row in msg_stream],
+                       dtype=bool)
+    latitudes = np.array([row['Latitude'] for row in msg_stream], dtype=np.float64)
+    longitudes = np.array([row['Longitude'] for row in msg_stream], dtype=np.float64)
+    times = np.array([row['Complete_Sys_Date'] for row in msg_stream], dtype='datetime64[us]')
+    return latitudes, longitudes, times, located
+
+
+def iter_locationoutliers(batches, distance='geodesic'):
+    """Détection des positions aberrantes d'un flux de messages lu par lots (par exemple
+    AISdb.iter_message_stream avec batch_size), sans charger le flux complet en mémoire.
+
+    Les lots sont des listes de dicts ou des MessageBatch. Produit des couples (messages, aberrants):
+    une liste de messages et une liste de booléens, ou un MessageBatch et un tableau de booléens, avec les
+    mêmes décisions que detect_locationoutliers sur le flux complet. Les une ou deux positions dont la
+    décision dépend des messages suivants sont reportées au lot suivant, ou à la fin du flux. Sans NumPy,
+    le flux est rassemblé puis traité par detect_locationoutliers."""
+    if np is None:
+        msg_stream = [row for batch in batches for row in batch]
+        if len(msg_stream) > 0:
+            yield msg_stream, _detect_locationoutliers_rows(msg_stream)
+        return
+
+    pending = None
+    at_start = True
+    for batch in batches:
+        if isinstance(batch, MessageBatch):
+            rows = batch if pending is None else MessageBatch.concat([pending, batch])
+        else:
+            rows = list(batch) if pending is None else pending + list(batch)
+        if len(rows) == 0:
+            continue
+        outliers, waiting, at_start = _locationoutliers(*_message_arrays(rows), distance=distance,
+                                                        at_start=at_start, final=False)
+        done = np.ones(len(rows), dtype=bool)
+        done[waiting] = False
+        if isinstance(rows, MessageBatch):
+            yield rows[done], outliers[done]
+            pending = rows[~done]
+        else:
+            yield [row for row, keep in zip(rows, done.tolist()) if keep], outliers[done].tolist()
+            pending = [rows[i] for i in waiting]
+
+    if pending is not None and len(pending) > 0:
+        outliers = _locationoutliers(*_message_arrays(pending), distance=distance, at_start=at_start)[0]
+        yield pending, (outliers if isinstance(pending, MessageBatch) else outliers.tolist())
+
+
+def _detect_locationoutliers_rows(msg_stream):
+    # implémentation ligne par ligne, sans NumPy
     # 1) liste chaînée
     linked_rows = [None] * len(msg_stream)
     link = None
@@ -166,3 +573,15 @@ def interpolatepassages(msg_stream):
     artificial_messages = []
 
     return artificial_messages
+
+
+def process_context():
+    """Contexte multiprocessing des pools de processus des programmes.
+
+    Les processus sont démarrés par 'forkserver' (ou 'spawn' s'il n'est pas disponible) et non par 'fork':
+    ils n'héritent ni de la connexion à la base de données ni des threads du processus principal. Les fonctions
+    exécutées dans le pool doivent donc être désignées par leur module importable (ais_parser.programs...).
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')